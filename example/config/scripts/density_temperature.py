@@ -1,57 +1,183 @@
 """
-Makes a rho-T plot. Uses the swiftsimio library.
+Makes a rho-T plot. Reads the snapshot directly with h5py, streaming
+the particles through the histogram in chunks. The datasets (and their
+units) are found through the swiftsimio metadata.
+
+The heavier imports (matplotlib, unyt, h5py, numba) are made inside the
+functions that need them, so that the script starts quickly when it does
+not need to make a figure (e.g. for --help).
 """
 
-import matplotlib.pyplot as plt
 import numpy as np
 
-from swiftsimio import load
-
-from unyt import mh, cm
-from matplotlib.colors import LogNorm
+from functools import partial
+from os import cpu_count
 
 # Set the limits of the figure.
 density_bounds = [10 ** (-9.5), 1e6]  # in nh/cm^3
 temperature_bounds = [10 ** (0), 10 ** (9.5)]  # in K
 bins = 256
 
+# Number of bins of the histograms that are cached on disk. By default (0)
+# the histograms are cached with the number of bins that is plotted. If
+# set (e.g. to 1024), any number of bins that divides this is made by
+# summing neighbouring cached bins, rather than by re-reading the snapshot,
+# at the cost of filling the (much larger) finer histogram the first time.
+cached_bins = 0
+
+
+def make_bins(bounds, bins):
+    """
+    Makes the logarithmically spaced bin edges between bounds, with
+    "bins" the number of bins (so there are bins + 1 edges).
+    """
+
+    return np.logspace(np.log10(bounds[0]), np.log10(bounds[1]), bins + 1)
+
+
+# Bin edges for the default number of bins, computed once.
+density_bins = make_bins(density_bounds, bins)
+temperature_bins = make_bins(temperature_bounds, bins)
 
-def get_data(filename, prefix_rho, prefix_T):
+
+# Attribute that SWIFT attaches to the particle datasets (in all but the
+# oldest snapshots).
+physical_cgs_factor = (
+    "Conversion factor to physical CGS (including cosmological corrections)"
+)
+
+
+def get_data(filename, handle, prefix_rho, prefix_T):
     """
-    Grabs the data (T in Kelvin and density in mh / cm^3).
+    Grabs the (unread) density and temperature datasets from the open
+    snapshot, along with the factors that convert their raw values to
+    physical mh / cm^3 and Kelvin.
+
+    Returning the factors, rather than converted arrays, means the
+    conversion is folded into the binning and the datasets can be read
+    chunk by chunk, with the particles only ever read once.
+
+    If the snapshot does not have the conversion factors, the (converted)
+    arrays are read through swiftsimio instead, with factors of one.
     """
 
+    from swiftsimio import load
+    from unyt import mh, cm, unyt_quantity
+
     data = load(filename)
 
-    number_density = (
-        getattr(data.gas, f"{prefix_rho}densities").to_physical() / mh
-    ).to(cm ** -3)
-    temperature = getattr(data.gas, f"{prefix_T}temperatures").to_physical().to("K")
+    gas_metadata = data.metadata.gas_properties
+    dataset_paths = dict(zip(gas_metadata.field_names, gas_metadata.field_paths))
+
+    density_name = f"{prefix_rho}densities"
+    temperature_name = f"{prefix_T}temperatures"
+
+    density = handle[dataset_paths[density_name]]
+    temperature = handle[dataset_paths[temperature_name]]
+
+    if (
+        physical_cgs_factor in density.attrs
+        and physical_cgs_factor in temperature.attrs
+    ):
+        density_factor = (
+            unyt_quantity(density.attrs[physical_cgs_factor][0], "g / cm**3") / mh
+        ).to(cm ** -3)
+        temperature_factor = temperature.attrs[physical_cgs_factor][0]
+
+        return (
+            density,
+            float(density_factor.value),
+            temperature,
+            float(temperature_factor),
+        )
+
+    number_density = (getattr(data.gas, density_name).to_physical() / mh).to(cm ** -3)
+    temperature = getattr(data.gas, temperature_name).to_physical().to("K")
 
-    return number_density.value, temperature.value
+    return number_density.value, 1.0, temperature.value, 1.0
 
 
-def make_hist(filename, density_bounds, temperature_bounds, bins, prefix_rho, prefix_T):
+def read_hist(
+    filename, density_bounds, temperature_bounds, bins, prefix_rho, prefix_T
+):
     """
-    Makes the histogram for filename with bounds as lower, higher
-    for the bins and "bins" the number of bins along each dimension.
+    Reads filename and bins it with "bins" logarithmically spaced bins
+    along each axis between the bounds.
+    """
+
+    import h5py
+    from swiftpipeline.histogram import log_histogram_2d
 
-    Also returns the edges for pcolormesh to use.
+    with h5py.File(filename, "r") as handle:
+        density, density_factor, temperature, temperature_factor = get_data(
+            filename, handle, prefix_rho, prefix_T
+        )
+
+        return log_histogram_2d(
+            x=density,
+            y=temperature,
+            x_bounds=density_bounds,
+            y_bounds=temperature_bounds,
+            bins=bins,
+            x_factor=density_factor,
+            y_factor=temperature_factor,
+        )
+
+
+def make_hist(
+    filename,
+    density_bins,
+    temperature_bins,
+    prefix_rho,
+    prefix_T,
+    cached_bins=cached_bins,
+):
     """
+    Makes the histogram for filename with the (logarithmically spaced)
+    bin edges density_bins and temperature_bins.
 
-    density_bins = np.logspace(
-        np.log10(density_bounds[0]), np.log10(density_bounds[1]), bins
-    )
-    temperature_bins = np.logspace(
-        np.log10(temperature_bounds[0]), np.log10(temperature_bounds[1]), bins
-    )
+    Also returns the edges for imshow to use.
+
+    The histogram is cached on disk, so re-running on the same snapshot
+    skips reading it entirely. If cached_bins is a multiple of the number
+    of bins, the cached histogram has cached_bins bins instead.
+    """
+
+    from swiftpipeline.histogram import coarsen_histogram, disk_cached_histogram
 
-    H, density_edges, temperature_edges = np.histogram2d(
-        *get_data(filename, prefix_rho, prefix_T),
-        bins=[density_bins, temperature_bins],
+    cached_read_hist = disk_cached_histogram()(read_hist)
+
+    number_of_bins = len(density_bins) - 1
+    bounds = dict(
+        density_bounds=[density_bins[0], density_bins[-1]],
+        temperature_bounds=[temperature_bins[0], temperature_bins[-1]],
+        prefix_rho=prefix_rho,
+        prefix_T=prefix_T,
     )
 
-    return H.T, density_edges, temperature_edges
+    if cached_bins > number_of_bins and cached_bins % number_of_bins == 0:
+        H = coarsen_histogram(
+            cached_read_hist(filename, bins=cached_bins, **bounds),
+            bins=number_of_bins,
+        )
+    else:
+        H = cached_read_hist(filename, bins=number_of_bins, **bounds)
+
+    return H, density_bins, temperature_bins
+
+
+def make_hist_in_worker(filename, **kwargs):
+    """
+    Calls make_hist in a worker process. Each snapshot already has its own
+    process (and swift-pipeline may be running several scripts at once),
+    so the histogram is only filled with a single thread.
+    """
+
+    from numba import set_num_threads
+
+    set_num_threads(1)
+
+    return make_hist(filename, **kwargs)
 
 
 def setup_axes(number_of_simulations: int, quantity_type):
@@ -60,51 +186,138 @@ def setup_axes(number_of_simulations: int, quantity_type):
     that add up to at least number_of_simulations.
     """
 
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import MaxNLocator, FuncFormatter
+
     sqrt_number_of_simulations = np.sqrt(number_of_simulations)
     horizontal_number = int(np.ceil(sqrt_number_of_simulations))
     # Ensure >= number_of_simulations plots in a grid
     vertical_number = int(np.ceil(number_of_simulations / horizontal_number))
 
+    # The layout is solved by constrained_layout, which also makes room
+    # for the single colour bar shared between all of the panels.
     fig, ax = plt.subplots(
-        vertical_number, horizontal_number, squeeze=True, sharex=True, sharey=True,
+        vertical_number,
+        horizontal_number,
+        squeeze=True,
+        sharex=True,
+        sharey=True,
+        constrained_layout=True,
     )
 
     ax = np.array([ax]) if number_of_simulations == 1 else ax
+    grid = ax.reshape(vertical_number, horizontal_number)
 
-    if horizontal_number * vertical_number > number_of_simulations:
-        for axis in ax.flat[number_of_simulations:]:
-            axis.axis("off")
-
-    # Set all valid on bottom row to have the horizontal axis label.
+    for axis in ax.flat[number_of_simulations:]:
+        axis.axis("off")
 
     if quantity_type == "hydro":
-        for axis in np.atleast_2d(ax)[:][-1]:
-            axis.set_xlabel("Density [$n_H$ cm$^{-3}$]")
+        xlabel = "Density [$n_H$ cm$^{-3}$]"
+        ylabel = "Temperature [K]"
+    else:
+        xlabel = "Subgrid Density [$n_H$ cm$^{-3}$]"
+        ylabel = "Subgrid Temperature [K]"
+
+    # Label the lowest visible panel in each column, which is on the row
+    # above the bottom one if the bottom row is not full.
+    bottom_row_panels = (
+        number_of_simulations - (vertical_number - 1) * horizontal_number
+    )
 
-        for axis in np.atleast_2d(ax).T[:][0]:
-            axis.set_ylabel("Temperature [K]")
+    for column, axis in enumerate(grid[-1]):
+        if column >= bottom_row_panels:
+            axis = grid[-2, column]
+            axis.xaxis.set_tick_params(labelbottom=True)
 
-    else:
-        for axis in np.atleast_2d(ax)[:][-1]:
-            axis.set_xlabel("Subgrid Density [$n_H$ cm$^{-3}$]")
+        axis.set_xlabel(xlabel)
 
-        for axis in np.atleast_2d(ax).T[:][0]:
-            axis.set_ylabel("Subgrid Temperature [K]")
+    for axis in grid[:, 0]:
+        axis.set_ylabel(ylabel)
 
-    ax.flat[0].loglog()
+    # The histograms are shown with imshow in log-space, so label the
+    # (linear) axes as powers of ten. These are shared between all panels.
+    for axis in [ax.flat[0].xaxis, ax.flat[0].yaxis]:
+        axis.set_major_locator(MaxNLocator(nbins="auto", integer=True))
+        axis.set_major_formatter(FuncFormatter(lambda x, _: f"$10^{{{x:.0f}}}$"))
 
     return fig, ax
 
 
+class DensityTemperatureCanvas(object):
+    """
+    Figure, axes, and images for a given panel layout. These are created
+    once, and then only have their data swapped out for any subsequent
+    set of histograms with the same layout.
+    """
+
+    def __init__(self, number_of_simulations, quantity_type, extent, bins):
+        from matplotlib.colors import LogNorm
+
+        self.fig, self.ax = setup_axes(
+            number_of_simulations=number_of_simulations, quantity_type=quantity_type
+        )
+
+        # Shared between all panels (and the colour bar), so that only
+        # vmax needs to be updated between figures. The initial vmax is
+        # a placeholder; it must differ from vmin for the colour bar.
+        self.norm = LogNorm(vmin=1, vmax=10)
+
+        self.images = []
+        self.labels = []
+
+        for axis in self.ax.flat[:number_of_simulations]:
+            self.images.append(
+                axis.imshow(
+                    np.zeros((bins, bins)),
+                    origin="lower",
+                    extent=extent,
+                    aspect="auto",
+                    interpolation="nearest",
+                    norm=self.norm,
+                )
+            )
+            self.labels.append(
+                axis.text(
+                    0.025, 0.975, "", ha="left", va="top", transform=axis.transAxes
+                )
+            )
+
+        self.fig.colorbar(
+            self.images[0], ax=self.ax.ravel().tolist(), label="Number of particles"
+        )
+
+    def save(self, hists, names, filename):
+        """
+        Swaps in the histograms (and names) and saves the figure.
+        """
+
+        for image, label, hist, name in zip(self.images, self.labels, hists, names):
+            image.set_data(hist)
+            label.set_text(name)
+
+        self.norm.vmax = np.max([np.max(hist) for hist in hists])
+
+        # Fast (light) PNG compression is a much better trade-off than the
+        # default when making hundreds of figures, and skip writing the
+        # software version metadata.
+        self.fig.savefig(
+            filename, pil_kwargs={"compress_level": 1}, metadata={"Software": None}
+        )
+
+
+# Canvases that have already been created, keyed by their layout.
+canvases = {}
+
+
 def make_single_image(
     filenames,
     names,
     number_of_simulations,
-    density_bounds,
-    temperature_bounds,
-    bins,
+    density_bins,
+    temperature_bins,
     output_path,
     quantity_type,
+    cached_bins=cached_bins,
 ):
     """
     Makes a single plot of rho-T
@@ -119,27 +332,47 @@ def make_single_image(
     else:
         raise Exception(f'Quantity type "{quantity_type}" not understood')
 
-    fig, ax = setup_axes(
-        number_of_simulations=number_of_simulations, quantity_type=quantity_type
+    hist_arguments = dict(
+        density_bins=density_bins,
+        temperature_bins=temperature_bins,
+        prefix_rho=prefix_rho,
+        prefix_T=prefix_T,
+        cached_bins=cached_bins,
     )
 
-    hists = []
+    # Each snapshot is read and binned independently, so for comparisons
+    # spread them over processes.
+    if len(filenames) > 1:
+        from p_tqdm import p_map
 
-    for filename in filenames:
-        hist, d, T = make_hist(
-            filename, density_bounds, temperature_bounds, bins, prefix_rho, prefix_T
+        outputs = p_map(
+            partial(make_hist_in_worker, **hist_arguments),
+            filenames,
+            num_cpus=min(len(filenames), cpu_count() or 1),
+            disable=True,
         )
-        hists.append(hist)
+    else:
+        outputs = [make_hist(filename, **hist_arguments) for filename in filenames]
 
-    vmax = np.max([np.max(hist) for hist in hists])
+    hists = [hist for hist, _, _ in outputs]
+    _, d, T = outputs[0]
 
-    for hist, name, axis in zip(hists, names, ax.flat):
-        mappable = axis.pcolormesh(d, T, hist, norm=LogNorm(vmin=1, vmax=vmax))
-        axis.text(0.025, 0.975, name, ha="left", va="top", transform=axis.transAxes)
+    extent = [np.log10(d[0]), np.log10(d[-1]), np.log10(T[0]), np.log10(T[-1])]
+    layout = (number_of_simulations, quantity_type, *extent, len(d) - 1)
 
-    fig.colorbar(mappable, ax=ax.ravel().tolist(), label="Number of particles")
+    if layout not in canvases:
+        canvases[layout] = DensityTemperatureCanvas(
+            number_of_simulations=number_of_simulations,
+            quantity_type=quantity_type,
+            extent=extent,
+            bins=len(d) - 1,
+        )
 
-    fig.savefig(f"{output_path}/{prefix_T}density_temperature.png")
+    canvases[layout].save(
+        hists=hists,
+        names=names,
+        filename=f"{output_path}/{prefix_T}density_temperature.png",
+    )
 
     return
 
@@ -149,9 +382,19 @@ if __name__ == "__main__":
 
     arguments = ScriptArgumentParser(
         description="Basic density-temperature figure.",
-        additional_arguments={"quantity_type": "hydro"},
+        additional_arguments={
+            "quantity_type": "hydro",
+            "bins": bins,
+            "cached_bins": cached_bins,
+        },
     )
 
+    # Fewer bins are useful for smaller figures; only re-compute the
+    # edges if the number requested differs from the default.
+    if int(arguments.bins) != bins:
+        density_bins = make_bins(density_bounds, int(arguments.bins))
+        temperature_bins = make_bins(temperature_bounds, int(arguments.bins))
+
     snapshot_filenames = [
         f"{directory}/{snapshot}"
         for directory, snapshot in zip(
@@ -159,15 +402,17 @@ if __name__ == "__main__":
         )
     ]
 
+    import matplotlib.pyplot as plt
+
     plt.style.use(arguments.stylesheet_location)
 
     make_single_image(
         filenames=snapshot_filenames,
         names=arguments.name_list,
         number_of_simulations=arguments.number_of_inputs,
-        density_bounds=density_bounds,
-        temperature_bounds=temperature_bounds,
-        bins=bins,
+        density_bins=density_bins,
+        temperature_bins=temperature_bins,
         output_path=arguments.output_directory,
         quantity_type=arguments.quantity_type,
+        cached_bins=int(arguments.cached_bins),
     )
@@ -29,6 +29,8 @@ setuptools.setup(
         "jinja2",
         "velociraptor",
         "unyt",
+        "numba",
+        "Pillow",
         "tqdm",
         "p_tqdm",
     ],
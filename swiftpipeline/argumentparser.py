@@ -7,6 +7,92 @@ from typing import List, Optional, Dict, Any
 from swiftpipeline.config import Config
 
 
+def create_base_parser() -> ap.ArgumentParser:
+    """
+    Creates the parser for the arguments that are common to all of the
+    additional scripts. This has no help option, as it is only used as a
+    parent of the parsers in ``ScriptArgumentParser``.
+
+    Returns
+    -------
+
+    parser: ap.ArgumentParser
+        Parser with the common arguments added.
+    """
+
+    parser = ap.ArgumentParser(add_help=False)
+
+    parser.add_argument(
+        "-s",
+        "--snapshots",
+        help="Snapshot list. Do not include directory. Example: snapshot_0000.hdf5",
+        type=str,
+        required=True,
+        nargs="*",
+    )
+
+    parser.add_argument(
+        "-c",
+        "--catalogues",
+        help=(
+            "Catalogue list. Do not include directory. Example: "
+            "catalogue_0000.properties"
+        ),
+        type=str,
+        required=True,
+        nargs="*",
+    )
+
+    parser.add_argument(
+        "-d",
+        "--input-directories",
+        help="Input directory list. Catalogue and snapshot are in this directory.",
+        type=str,
+        required=True,
+        nargs="*",
+    )
+
+    parser.add_argument(
+        "-n",
+        "--run-names",
+        help="Names of the runs for placement in legends.",
+        type=str,
+        required=False,
+        nargs="*",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output-directory",
+        help="Output directory for the produced figure.",
+        type=str,
+        required=True,
+    )
+
+    parser.add_argument(
+        "-C",
+        "--config",
+        help="Config directory that contains config.yaml",
+        type=str,
+        required=True,
+    )
+
+    parser.add_argument(
+        "-a",
+        "--additional-args",
+        help="Additional command line args for a given script",
+        type=str,
+        required=False,
+        nargs="*",
+    )
+
+    return parser
+
+
+# Created once per process and shared between all of the script parsers.
+base_parser = create_base_parser()
+
+
 class ScriptArgumentParser(object):
     """
     Script argument parser for ``swiftpipeline`` additional scripts.
@@ -88,70 +174,10 @@ class ScriptArgumentParser(object):
         Set up the argument parser.
         """
 
-        self.parser = ap.ArgumentParser(description=self.description)
-
-        self.parser.add_argument(
-            "-s",
-            "--snapshots",
-            help="Snapshot list. Do not include directory. Example: snapshot_0000.hdf5",
-            type=str,
-            required=True,
-            nargs="*",
-        )
-
-        self.parser.add_argument(
-            "-c",
-            "--catalogues",
-            help=(
-                "Catalogue list. Do not include directory. Example: "
-                "catalogue_0000.properties"
-            ),
-            type=str,
-            required=True,
-            nargs="*",
-        )
-
-        self.parser.add_argument(
-            "-d",
-            "--input-directories",
-            help="Input directory list. Catalogue and snapshot are in this directory.",
-            type=str,
-            required=True,
-            nargs="*",
-        )
-
-        self.parser.add_argument(
-            "-n",
-            "--run-names",
-            help="Names of the runs for placement in legends.",
-            type=str,
-            required=False,
-            nargs="*",
-        )
-
-        self.parser.add_argument(
-            "-o",
-            "--output-directory",
-            help="Output directory for the produced figure.",
-            type=str,
-            required=True,
-        )
-
-        self.parser.add_argument(
-            "-C",
-            "--config",
-            help="Config directory that contains config.yaml",
-            type=str,
-            required=True,
-        )
-
-        self.parser.add_argument(
-            "-a",
-            "--additional-args",
-            help="Additional command line args for a given script",
-            type=str,
-            required=False,
-            nargs="*",
+        # The arguments common to all scripts are only set up once, in
+        # base_parser, and shared between every parser.
+        self.parser = ap.ArgumentParser(
+            description=self.description, parents=[base_parser]
         )
 
         for key, value in self.additional_arguments.items():
@@ -188,7 +214,7 @@ class ScriptArgumentParser(object):
         for key, value in self.additional_arguments.items():
             setattr(self, key, getattr(args, key, None))
 
-        self.config = Config(config_directory=self.config_directory)
+        self.config = Config.load(config_directory=self.config_directory)
 
         return
 
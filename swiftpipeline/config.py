@@ -3,9 +3,28 @@ Configuration object for the entire pipeline.
 """
 
 import yaml
-from typing import List, Union
+import json
+import hashlib
+from typing import List, Dict, Union
+from functools import lru_cache
+from copy import deepcopy
+from tempfile import NamedTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
 import os
-import glob
+import stat
+
+# Use the LibYAML bindings where available, which are much faster than the
+# pure python loader.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Base directory of the pipeline's caches (e.g. of histograms and compiled
+# templates), usually ~/.cache/swiftpipeline.
+cache_directory = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "swiftpipeline"
+)
 
 # Items to read directly from the yaml file with their defaults
 direct_read = {
@@ -27,6 +46,200 @@ appendable_config_keys = [
     "auto_plotter_registration",
 ]
 
+# Properties of each script, with their defaults
+script_defaults = {
+    "filename": "",
+    "caption": "",
+    "output_file": "",
+    "section": "",
+    "title": "",
+    "show_on_webpage": True,
+    "additional_arguments": {},
+    "use_for_comparison": True,
+}
+
+# Configurations loaded by Config.load, keyed by their directory, along with
+# the modification times of their files when they were read.
+loaded_configs = {}
+
+
+def _sidecar_filename(filename: str) -> str:
+    """
+    Gets the name of the (hidden) JSON file that stores the parsed
+    contents of the yaml file ``filename``, e.g. config.yml ->
+    .config.yml.json.
+    """
+
+    directory, basename = os.path.split(filename)
+
+    return os.path.join(directory, f".{basename}.json")
+
+
+def _write_sidecar(filename: str, modification_time: int, contents):
+    """
+    Writes the parsed contents of a yaml file to its JSON sidecar. This is
+    skipped if the contents do not survive the trip through JSON (e.g.
+    dates, or non-string keys), or if the directory is not writeable.
+    """
+
+    temporary_filename = None
+
+    try:
+        serialised = json.dumps(
+            dict(modification_time=modification_time, contents=contents)
+        )
+
+        if json.loads(serialised)["contents"] != contents:
+            return
+
+        with NamedTemporaryFile(
+            "w", dir=os.path.dirname(filename) or ".", suffix=".tmp", delete=False
+        ) as handle:
+            temporary_filename = handle.name
+            handle.write(serialised)
+
+        # Temporary files are only readable by their owner, but the sidecar
+        # should be as readable as the file it is made from.
+        os.chmod(temporary_filename, stat.S_IMODE(os.stat(filename).st_mode))
+        os.replace(temporary_filename, _sidecar_filename(filename))
+    except (OSError, TypeError, ValueError):
+        if temporary_filename is not None:
+            try:
+                os.remove(temporary_filename)
+            except OSError:
+                pass
+
+    return
+
+
+@lru_cache(maxsize=16)
+def _parse_yaml(filename: str, modification_time: int):
+    """
+    Parses a yaml file. Cached so that repeatedly setting up a ``Config``
+    for the same (unchanged) directory does not re-parse it.
+
+    Between processes, the parsed contents are kept in a JSON sidecar
+    file next to the yaml file, which is much faster to read. This is
+    only used if it was written for the current modification time of the
+    yaml file.
+    """
+
+    try:
+        with open(_sidecar_filename(filename), "rb") as handle:
+            sidecar = json.load(handle)
+
+        if sidecar["modification_time"] == modification_time:
+            return sidecar["contents"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    # Read the whole (small) file in one go, rather than letting the loader
+    # make many small reads, which is slow on networked file systems.
+    with open(filename, "rb") as handle:
+        contents = yaml.load(handle.read(), Loader=SafeLoader)
+
+    _write_sidecar(filename, modification_time, contents)
+
+    return contents
+
+
+def load_yaml(filename: str):
+    """
+    Loads a yaml file, re-using the parsed contents if the file has not
+    changed since it was last read.
+
+    Parameters
+    ----------
+
+    filename: str
+        Path to the yaml file.
+
+    Returns
+    -------
+
+    contents: dict
+        The parsed contents of the file. This is a copy, so it is safe to
+        modify.
+    """
+
+    return deepcopy(_parse_yaml(filename, os.stat(filename).st_mtime_ns))
+
+
+def stable_id(*parts: str) -> int:
+    """
+    Creates a (positive) integer identifier from strings, e.g. for the
+    sections and plots on the webpages. Unlike ``hash``, this is the same
+    between runs, and no intermediate joined string is created.
+
+    Parameters
+    ----------
+
+    parts: str
+        Strings to create the identifier from.
+
+    Returns
+    -------
+
+    identifier: int
+        64 bit identifier.
+    """
+
+    digest = hashlib.blake2b(digest_size=8)
+
+    for part in parts:
+        # Separate the parts so that e.g. ("ab", "c") and ("a", "bc") differ
+        digest.update(part.encode())
+        digest.update(b"\0")
+
+    return int.from_bytes(digest.digest(), "big")
+
+
+@lru_cache(maxsize=256)
+def _list_yaml_files(directory: str, modification_time: int):
+    """
+    Lists the yaml files in a directory. Cached, with the modification
+    time of the directory (which changes when files are added or removed)
+    only used as part of the cache key.
+    """
+
+    with os.scandir(directory) as entries:
+        return tuple(
+            sorted(
+                (
+                    entry.path
+                    for entry in entries
+                    if entry.name.endswith(".yml") and not entry.name.startswith(".")
+                ),
+                reverse=True,
+            )
+        )
+
+
+def list_yaml_files(directory: str) -> List[str]:
+    """
+    Lists the (non-hidden) ``.yml`` files in a directory, in reverse
+    alphabetical order.
+
+    Parameters
+    ----------
+
+    directory: str
+        Directory to search. If this does not exist, no files are returned.
+
+    Returns
+    -------
+
+    filenames: List[str]
+        Paths to the yaml files, including the directory.
+    """
+
+    try:
+        modification_time = os.stat(directory).st_mtime_ns
+    except OSError:
+        return []
+
+    return list(_list_yaml_files(directory, modification_time))
+
 
 class Script(object):
     """
@@ -56,20 +269,27 @@ class Script(object):
     # Use in the case where we have comparisons? The scripts may be disabled
     # in comparison cases for performance reasons.
     use_for_comparison: bool
+    # Identifier for the section, used in the webpages.
+    section_id: int
+
+    # Large configurations contain hundreds of scripts, so avoid giving
+    # each one its own __dict__.
+    __slots__ = list(script_defaults.keys()) + [
+        "section_id",
+        "_additional_argument_list",
+    ]
 
     def __init__(self, script_dict: dict):
         """
         Takes the dictionary and extracts it to inner variables.
         """
 
-        self.filename = script_dict.get("filename", "")
-        self.caption = script_dict.get("caption", "")
-        self.output_file = script_dict.get("output_file", "")
-        self.section = script_dict.get("section", "")
-        self.title = script_dict.get("title", "")
-        self.show_on_webpage = script_dict.get("show_on_webpage", True)
-        self.additional_arguments = script_dict.get("additional_arguments", {})
-        self.use_for_comparison = script_dict.get("use_for_comparison", True)
+        for variable, default in script_defaults.items():
+            setattr(self, variable, script_dict.get(variable, default))
+
+        self.section_id = stable_id(self.section)
+        self._additional_argument_list = None
+
         return
 
     def __str__(self):
@@ -84,16 +304,21 @@ class Script(object):
     @property
     def additional_argument_list(self):
         """
-        Gets a list of additional arguments, with --key, value ordering.
+        Gets the additional arguments, with --key, value ordering. This is
+        built on first access, and returned as a tuple so that the cached
+        version cannot be modified.
         """
 
-        additional_arguments = []
+        if self._additional_argument_list is None:
+            additional_arguments = []
+
+            for key, value in self.additional_arguments.items():
+                additional_arguments.append(f"--{key}")
+                additional_arguments.append(f"{value}")
 
-        for key, value in self.additional_arguments.items():
-            additional_arguments.append(f"--{key}")
-            additional_arguments.append(f"{value}")
+            self._additional_argument_list = tuple(additional_arguments)
 
-        return additional_arguments
+        return self._additional_argument_list
 
 
 class SpecialMode(object):
@@ -104,13 +329,20 @@ class SpecialMode(object):
     name: str
     script_file: str
 
+    __slots__ = ["name", "script_file", "_code"]
+
     def __init__(self, name: str, script_file: str):
         self.name = name
         self.script_file = script_file
+        self._code = None
 
     def adapt_catalogue(self, catalogue):
-        with open(self.script_file, "r") as handle:
-            exec(handle.read())
+        # Only read and compile the script once, the first time it is used.
+        if self._code is None:
+            with open(self.script_file, "r") as handle:
+                self._code = compile(handle.read(), self.script_file, "exec")
+
+        exec(self._code, {"catalogue": catalogue})
 
 
 class Config(object):
@@ -122,11 +354,17 @@ class Config(object):
     # Raw config read directly from the file, before processing.
     raw_config: dict
     raw_scripts: List[Script]
+    # Scripts grouped by their section, in the order they first appear.
+    scripts_by_section: Dict[str, List[Script]]
+    # Scripts only to be used in comparisons.
+    comparison_scripts: List[Script]
     raw_specials: List[SpecialMode]
 
     # Set up the object.
     __slots__ = list(direct_read.keys()) + [
         "raw_scripts",
+        "scripts_by_section",
+        "comparison_scripts",
         "raw_specials",
         "config_directory",
         "raw_config",
@@ -153,6 +391,56 @@ class Config(object):
 
         return
 
+    @classmethod
+    def load(cls, config_directory: str) -> "Config":
+        """
+        Gets the configuration for ``config_directory``, re-using the one
+        loaded earlier in this process if none of its files (``config.yml``
+        and any ``extra_config`` files) have changed since.
+
+        Parameters
+        ----------
+
+        config_directory: str
+            Directory containing the configuration ``config.yml``.
+
+        Returns
+        -------
+
+        config: Config
+            The configuration object. This is shared between callers, so
+            should not be modified.
+        """
+
+        modification_times, config = loaded_configs.get(config_directory, (None, None))
+
+        if config is None or modification_times != config.modification_times:
+            config = cls(config_directory=config_directory)
+            loaded_configs[config_directory] = (config.modification_times, config)
+
+        return config
+
+    @property
+    def modification_times(self) -> List[int]:
+        """
+        Modification times of all of the files that make up this
+        configuration, used to check whether it needs to be re-read.
+        """
+
+        filenames = ["config.yml"] + list(self.raw_config.get("extra_config", []))
+
+        modification_times = []
+
+        for filename in filenames:
+            try:
+                modification_times.append(
+                    os.stat(f"{self.config_directory}/{filename}").st_mtime_ns
+                )
+            except OSError:
+                modification_times.append(None)
+
+        return modification_times
+
     def __str__(self):
         return f"Configuration file object describing {self.config_directory}"
 
@@ -165,35 +453,51 @@ class Config(object):
         ``self.raw_config``.
         """
 
-        with open(f"{self.config_directory}/config.yml", "r") as handle:
-            self.raw_config = yaml.safe_load(handle)
+        self.raw_config = load_yaml(f"{self.config_directory}/config.yml")
+
+        # Make sure that all of the appendable keys are lists
         for key in appendable_config_keys:
-            if key in self.raw_config:
-                if not isinstance(self.raw_config[key], list):
-                    self.raw_config[key] = [self.raw_config[key]]
-            else:
-                self.raw_config[key] = []
-
-        if "extra_config" in self.raw_config:
-            for extra_config_file in self.raw_config["extra_config"]:
-                extra_raw_config = None
-                with open(
-                    f"{self.config_directory}/{extra_config_file}", "r"
-                ) as handle:
-                    extra_raw_config = yaml.safe_load(handle)
-                for key in extra_raw_config:
-                    if key in appendable_config_keys:
-                        # append additional items
-                        extra_list = extra_raw_config[key]
-                        if not isinstance(extra_list, list):
-                            extra_list = [extra_list]
-                        for extra_item in extra_list:
-                            self.raw_config[key].append(extra_item)
-                    else:
-                        # if the key is not an appendable list, it must be a
-                        # parameter that can only have one value
-                        # overwrite the original value
-                        self.raw_config[key] = extra_raw_config[key]
+            value = self.raw_config.setdefault(key, [])
+
+            if not isinstance(value, list):
+                self.raw_config[key] = [value]
+
+        extra_config_filenames = [
+            f"{self.config_directory}/{extra_config_file}"
+            for extra_config_file in self.raw_config.get("extra_config", [])
+        ]
+
+        # Reading the files is dominated by file system latency, so read them
+        # all at once if there are several; they are still merged in order
+        # below.
+        if len(extra_config_filenames) > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(8, len(extra_config_filenames))
+            ) as executor:
+                extra_raw_configs = list(
+                    executor.map(load_yaml, extra_config_filenames)
+                )
+        else:
+            extra_raw_configs = [load_yaml(x) for x in extra_config_filenames]
+
+        for extra_raw_config in extra_raw_configs:
+            for key, value in extra_raw_config.items():
+                if key in appendable_config_keys:
+                    # append additional items
+                    self.raw_config[key].extend(
+                        value if isinstance(value, list) else [value]
+                    )
+                else:
+                    # if the key is not an appendable list, it must be a
+                    # parameter that can only have one value
+                    # overwrite the original value
+                    self.raw_config[key] = value
+
+        # Several configs may register the same files, which only need to be
+        # loaded once.
+        self.raw_config["auto_plotter_registration"] = list(
+            dict.fromkeys(self.raw_config["auto_plotter_registration"])
+        )
 
         return
 
@@ -211,19 +515,19 @@ class Config(object):
             if os.path.isfile(auto_plotter_config):
                 self.auto_plotter_configs.append(auto_plotter_config)
             else:
-                self.auto_plotter_configs.extend(
-                    reversed(glob.glob(f"{auto_plotter_config}/*.yml"))
-                )
+                self.auto_plotter_configs.extend(list_yaml_files(auto_plotter_config))
         # support legacy auto_plotter_directory variable
         if "auto_plotter_directory" in self.raw_config:
             self.auto_plotter_configs.extend(
-                reversed(
-                    glob.glob(
-                        f"{self.config_directory}/{self.raw_config['auto_plotter_directory']}/*.yml"
-                    )
+                list_yaml_files(
+                    f"{self.config_directory}/{self.raw_config['auto_plotter_directory']}"
                 )
             )
 
+        # Remove any duplicates (e.g. from extra configs that share a
+        # directory), keeping the first occurrence.
+        self.auto_plotter_configs = list(dict.fromkeys(self.auto_plotter_configs))
+
         return
 
     def __extract_scripts(self):
@@ -237,6 +541,15 @@ class Config(object):
             Script(script_dict=script_dict) for script_dict in raw_scripts
         ]
 
+        self.comparison_scripts = [
+            script for script in self.raw_scripts if script.use_for_comparison
+        ]
+
+        self.scripts_by_section = {}
+
+        for script in self.raw_scripts:
+            self.scripts_by_section.setdefault(script.section, []).append(script)
+
         return
 
     def __extract_specials(self):
@@ -256,14 +569,6 @@ class Config(object):
         """
         return self.raw_scripts
 
-    @property
-    def comparison_scripts(self):
-        """
-        Gets the scripts only to be used in comparisons from the parameter
-        file.
-        """
-        return [script for script in self.raw_scripts if script.use_for_comparison]
-
     def get_special_mode(self, mode):
         if not mode in self.raw_specials:
             raise AttributeError(f"Unknown special mode: {mode}!")
@@ -0,0 +1,103 @@
+"""
+Helpers for choosing which haloes to make images of, working only on
+plain arrays of their properties (so that they can be used, and tested,
+without reading a catalogue or snapshot).
+"""
+
+import numpy as np
+
+from typing import List
+
+
+def subsample_bins(
+    digitized: np.array, maximum_per_bin: int, rng: np.random.Generator
+) -> np.array:
+    """
+    Randomly chooses at most ``maximum_per_bin`` haloes from each bin.
+
+    Rather than looping over the bins, every halo is given a random key
+    and the haloes are sorted by (bin, key). The haloes in each bin are
+    then contiguous and in a random order, so the first
+    ``maximum_per_bin`` of each are kept.
+
+    Parameters
+    ----------
+
+    digitized: np.array
+        Bin index of each halo, as returned by ``np.digitize``. Haloes in
+        bin 0 (below the lowest bin edge) are never chosen.
+
+    maximum_per_bin: int
+        Maximum number of haloes to choose from each bin.
+
+    rng: np.random.Generator
+        Source of randomness for the choice.
+
+    Returns
+    -------
+
+    chosen: np.array
+        Boolean mask, the same size as ``digitized``, that is true for the
+        chosen haloes.
+    """
+
+    keys = rng.random(digitized.size)
+    order = np.lexsort((keys, digitized))
+
+    counts = np.bincount(digitized)
+    starts = np.cumsum(counts) - counts
+    rank_in_bin = np.arange(digitized.size) - np.repeat(starts, counts)
+
+    selected = np.logical_and(rank_in_bin < maximum_per_bin, digitized[order] > 0)
+
+    chosen = np.zeros(digitized.size, dtype=bool)
+    chosen[order[selected]] = True
+
+    return chosen
+
+
+def group_nested_regions(positions: np.array, radii: np.array) -> List[np.array]:
+    """
+    Groups together cubic regions that lie entirely within a larger
+    region, such that only the larger region needs to be read.
+
+    Starting from the largest, each region not yet in a group becomes
+    the parent of a new group, along with all of the remaining regions
+    that it contains.
+
+    Parameters
+    ----------
+
+    positions: np.array
+        Centres of the regions, of shape (number of regions, 3).
+
+    radii: np.array
+        Half-widths of the regions, in the same units as ``positions``.
+
+    Returns
+    -------
+
+    groups: List[np.array]
+        Indices of the regions in each group. The first is the parent,
+        whose region contains those of all of the others.
+    """
+
+    assigned = np.zeros(len(radii), dtype=bool)
+    groups = []
+
+    for parent in np.argsort(radii, kind="stable")[::-1]:
+        if assigned[parent]:
+            continue
+
+        # The regions are cubes, so a region is contained if it is inside
+        # along every axis.
+        separations = np.abs(positions - positions[parent]).max(axis=1)
+        contained = np.logical_and(~assigned, separations + radii <= radii[parent])
+        contained[parent] = False
+
+        assigned[parent] = True
+        assigned[contained] = True
+
+        groups.append(np.concatenate([[parent], np.where(contained)[0]]))
+
+    return groups
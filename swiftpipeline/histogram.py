@@ -0,0 +1,336 @@
+"""
+Fast two-dimensional histograms for the additional plotting scripts.
+
+The density-temperature style figures bin hundreds of millions of
+particles into logarithmically spaced bins. As the bins are uniform in
+log-space, the bin index of every particle can be computed directly
+rather than searched for, which is what ``np.histogram2d`` does.
+
+The particles are split between threads, with each thread filling its
+own private copy of the histogram. These are summed at the end, which
+avoids any contention on the (small) histogram itself.
+
+Histograms can also be cached on disk with ``disk_cached_histogram``,
+so that re-running a script on an unchanged snapshot (e.g. whilst
+adjusting the style of a figure) does not require re-reading it. These
+are stored compressed, as most bins are usually empty, and a single
+high resolution cached histogram can be reduced to any lower resolution
+that divides it with ``coarsen_histogram``.
+"""
+
+import numpy as np
+import hashlib
+import os
+
+from functools import wraps
+from numba import jit, prange, get_num_threads
+from typing import List, Callable, Optional
+
+from swiftpipeline.config import cache_directory
+
+# Default location of the on-disk histogram cache.
+default_cache_directory = cache_directory
+
+# Version of the cached histograms, which is part of their cache key. This
+# must be increased whenever the histograms produced for the same arguments
+# change (e.g. the binning, or the data read by the plotting scripts), so
+# that old cached histograms are not used.
+cache_version = 1
+
+
+# Compiling the kernel takes longer than binning a typical snapshot, and
+# every plotting script runs in its own process, so keep the compiled
+# version in numba's on-disk cache (next to this file, or in the user's
+# cache directory if that is not writeable).
+@jit(nopython=True, parallel=True, cache=True)
+def _fill_log_histogram(
+    x: np.array,
+    y: np.array,
+    x_lower: float,
+    x_inverse_width: float,
+    y_lower: float,
+    y_inverse_width: float,
+    histogram: np.array,
+):
+    """
+    Adds the particles in ``x`` and ``y`` to ``histogram`` in a single
+    pass. Particles outside of the bins are added to the overflow bins
+    around the edge of ``histogram``, rather than being skipped, so the
+    inner loop has no unpredictable branches.
+
+    Parameters
+    ----------
+
+    x: np.array
+        Particle values along the horizontal axis (linear).
+
+    y: np.array
+        Particle values along the vertical axis (linear).
+
+    x_lower: float
+        log10 of the lower edge of the first bin in x.
+
+    x_inverse_width: float
+        Inverse of the bin width in x, in dex.
+
+    y_lower: float
+        log10 of the lower edge of the first bin in y.
+
+    y_inverse_width: float
+        Inverse of the bin width in y, in dex.
+
+    histogram: np.array
+        Per-thread histograms of shape (threads, y bins + 2, x bins + 2)
+        to add the particles to, with the first and last bins along each
+        axis used for overflow. Each thread only writes to its own
+        histogram.
+    """
+
+    number_of_threads, number_of_y_bins, number_of_x_bins = histogram.shape
+    particles_per_thread = x.size // number_of_threads + 1
+
+    # Highest (overflow) bin index along each axis.
+    x_overflow = float(number_of_x_bins - 1)
+    y_overflow = float(number_of_y_bins - 1)
+
+    for thread in prange(number_of_threads):
+        thread_histogram = histogram[thread]
+
+        start = thread * particles_per_thread
+        end = min(start + particles_per_thread, x.size)
+
+        for i in range(start, end):
+            x_index = (np.log10(x[i]) - x_lower) * x_inverse_width + 1.0
+            y_index = (np.log10(y[i]) - y_lower) * y_inverse_width + 1.0
+
+            # Clamp before casting to an integer. The argument order here
+            # matters: max(0.0, nan) is 0.0, so NaNs (and zeroes, through
+            # -inf) end up in the underflow bin.
+            x_index = min(x_overflow, max(0.0, x_index))
+            y_index = min(y_overflow, max(0.0, y_index))
+
+            thread_histogram[int(y_index), int(x_index)] += 1
+
+    return
+
+
+def log_histogram_2d(
+    x: np.array,
+    y: np.array,
+    x_bounds: List[float],
+    y_bounds: List[float],
+    bins: int,
+    x_factor: float = 1.0,
+    y_factor: float = 1.0,
+    chunk_size: int = 1 << 20,
+) -> np.array:
+    """
+    Creates a two-dimensional histogram of ``x`` and ``y`` with bins
+    that are uniformly spaced in log-space.
+
+    Parameters
+    ----------
+
+    x: np.array
+        Values along the horizontal axis. May also be anything that can
+        be sliced to give an array, such as a ``h5py`` dataset, in which
+        case it is only read ``chunk_size`` values at a time.
+
+    y: np.array
+        Values along the vertical axis. Must have the same size as ``x``,
+        and as for ``x`` may be a ``h5py`` dataset.
+
+    x_bounds: List[float]
+        Lower and upper edges of the bins along the horizontal axis.
+
+    y_bounds: List[float]
+        Lower and upper edges of the bins along the vertical axis.
+
+    bins: int
+        Number of bins along each axis.
+
+    x_factor: float, optional
+        Factor to multiply ``x`` by before binning, for instance a unit
+        conversion. This is folded into the bin edges, so ``x`` can be
+        passed directly as read from the file. Default: 1.0.
+
+    y_factor: float, optional
+        As ``x_factor``, but for ``y``. Default: 1.0.
+
+    chunk_size: int, optional
+        Number of particles to read and bin at a time. The default of
+        2^20 particles keeps the buffers small enough to stay in cache.
+
+    Returns
+    -------
+
+    histogram: np.array
+        Number of particles in each bin, of shape (bins, bins). Note that
+        the first index corresponds to ``y``, and the second to ``x``,
+        such that this can be passed directly to the matplotlib image
+        functions. This is C-contiguous.
+    """
+
+    # The kernel does not check its bounds, so would read past the end of
+    # a shorter y.
+    if len(x) != len(y):
+        raise ValueError(
+            f"x and y must have the same length, not {len(x)} and {len(y)}."
+        )
+
+    # log10(x * factor) - lower = log10(x) - (lower - log10(factor))
+    x_lower, x_upper = np.log10(x_bounds) - np.log10(x_factor)
+    y_lower, y_upper = np.log10(y_bounds) - np.log10(y_factor)
+
+    histogram = np.zeros((get_num_threads(), bins + 2, bins + 2), dtype=np.int64)
+
+    for start in range(0, len(x), chunk_size):
+        end = start + chunk_size
+
+        # Single precision is plenty for the bin index, and halves the
+        # memory traffic (SWIFT snapshots are usually stored as floats).
+        _fill_log_histogram(
+            np.ascontiguousarray(x[start:end], dtype=np.float32),
+            np.ascontiguousarray(y[start:end], dtype=np.float32),
+            x_lower,
+            bins / (x_upper - x_lower),
+            y_lower,
+            bins / (y_upper - y_lower),
+            histogram,
+        )
+
+    # Strip off the overflow bins, returning a C-contiguous copy so that
+    # matplotlib (and the cache) do not have to walk a strided view.
+    return np.ascontiguousarray(histogram.sum(axis=0)[1:-1, 1:-1])
+
+
+def coarsen_histogram(histogram: np.array, bins: int) -> np.array:
+    """
+    Reduces the resolution of a histogram by summing neighbouring bins.
+
+    Parameters
+    ----------
+
+    histogram: np.array
+        Two-dimensional histogram, with a number of bins along each axis
+        that is a multiple of ``bins``.
+
+    bins: int
+        Number of bins along each axis of the output histogram.
+
+    Returns
+    -------
+
+    coarse_histogram: np.array
+        Histogram of shape (bins, bins).
+    """
+
+    number_of_y_bins, number_of_x_bins = histogram.shape
+
+    if number_of_y_bins % bins != 0 or number_of_x_bins % bins != 0:
+        raise ValueError(
+            f"Unable to coarsen a histogram of shape {histogram.shape} to {bins} bins."
+        )
+
+    return histogram.reshape(
+        bins, number_of_y_bins // bins, bins, number_of_x_bins // bins
+    ).sum(axis=(1, 3))
+
+
+def _update_key(key, argument):
+    """
+    Adds an argument of the cached function to the hash ``key``.
+    """
+
+    # The repr of large arrays is truncated, so use their contents, along
+    # with everything needed to interpret them (including any units, for
+    # unyt arrays).
+    if isinstance(argument, np.ndarray):
+        units = getattr(argument, "units", "")
+        key.update(f"{argument.dtype}|{argument.shape}|{units}|".encode())
+        key.update(argument.tobytes())
+    else:
+        key.update(repr(argument).encode())
+
+    return
+
+
+def disk_cached_histogram(directory: Optional[str] = None) -> Callable:
+    """
+    Decorator that caches the histogram returned by a function on disk.
+
+    The decorated function must take the filename of the snapshot as its
+    first argument, and return a single ``np.array``, which is stored
+    as a compressed ``.npz`` file. The cache key
+    includes the path, size, and modification time of the snapshot along
+    with all of the other arguments, so the cache is invalidated if the
+    snapshot changes or the function is called with different binning.
+    It also includes ``cache_version``, which invalidates all of the
+    cached histograms when it is increased.
+
+    Parameters
+    ----------
+
+    directory: str, optional
+        Directory to store the cached histograms in. Defaults to
+        ``$XDG_CACHE_HOME/swiftpipeline`` (usually
+        ``~/.cache/swiftpipeline``).
+
+    Returns
+    -------
+
+    decorator: Callable
+        Decorator to apply to the histogramming function.
+    """
+
+    cache_directory = directory if directory is not None else default_cache_directory
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(filename, *args, **kwargs):
+            stat = os.stat(filename)
+
+            key = hashlib.blake2b(digest_size=16)
+            key.update(f"{cache_version}|{function.__qualname__}".encode())
+            path = os.path.realpath(filename)
+            key.update(f"{path}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+
+            for argument in args:
+                _update_key(key, argument)
+
+            for name, argument in sorted(kwargs.items()):
+                key.update(name.encode())
+                _update_key(key, argument)
+
+            cache_filename = os.path.join(cache_directory, f"{key.hexdigest()}.npz")
+
+            try:
+                with np.load(cache_filename) as cached:
+                    return cached["histogram"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+            histogram = function(filename, *args, **kwargs)
+
+            # Failing to write the cache (e.g. on a read-only file system)
+            # should never stop the figure from being made.
+            temporary_filename = f"{cache_filename}.{os.getpid()}.tmp"
+
+            try:
+                os.makedirs(cache_directory, exist_ok=True)
+
+                with open(temporary_filename, "wb") as handle:
+                    np.savez_compressed(handle, histogram=histogram)
+
+                os.replace(temporary_filename, cache_filename)
+            except OSError:
+                try:
+                    os.remove(temporary_filename)
+                except OSError:
+                    pass
+
+            return histogram
+
+        return wrapper
+
+    return decorator
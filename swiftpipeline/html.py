@@ -3,41 +3,76 @@ Functions that aid in the production of the HTML webpages.
 """
 
 from swiftpipeline import __version__ as pipeline_version
-from swiftpipeline.config import Config
+from swiftpipeline.config import Config, stable_id, cache_directory
 
 from swiftsimio import SWIFTDataset
 
 from velociraptor import __version__ as velociraptor_version
 from velociraptor.autoplotter.metadata import AutoPlotterMetadata
 
-from jinja2 import Environment, PackageLoader, FileSystemLoader, select_autoescape
+from jinja2 import (
+    Environment,
+    PackageLoader,
+    FileSystemLoader,
+    FileSystemBytecodeCache,
+    Template,
+    select_autoescape,
+)
 from time import strftime
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional
 from pathlib import Path
 
 import unyt
+import os
 
 
-def format_number(number):
+@lru_cache(maxsize=4096)
+def _format_number(value: float, units: str) -> str:
     """
-    Formats a number from float (with or without units) to a latex-like number.
+    Formats a float to a latex-like number, with the (already formatted)
+    units appended. Cached, as the same values (e.g. box sizes and
+    redshifts) are formatted for every snapshot in a comparison.
     """
 
-    try:
-        units = f"\\; {number.units.latex_repr}"
-    except:
-        units = ""
+    mantissa, separator, exponent = format(value, ".3g").partition("e")
 
-    try:
-        mantissa, exponent = ("%.3g" % number).split("e+")
+    # Numbers with an exponent (either sign) are written as powers of ten
+    if separator:
         exponent = f" \\times 10^{{{int(exponent)}}}"
-    except:
-        mantissa = "%.3g" % number
-        exponent = ""
 
     return f"\\({mantissa}{exponent}{units}\\)"
 
 
+def format_number(number):
+    """
+    Formats a number from float (with or without units) to a latex-like number.
+    """
+
+    units = getattr(number, "units", None)
+    units = f"\\; {units.latex_repr}" if units is not None else ""
+
+    return _format_number(float(number), units)
+
+
+@lru_cache(maxsize=4096)
+def _format_quantity(value, input_unit=None, output_unit=None):
+    """
+    Formats a value, optionally attaching and converting units, for the
+    get_if_present_* filters. The units are only created if requested.
+    Cached for the same reason as ``_format_number``.
+    """
+
+    if input_unit is not None:
+        value = unyt.unyt_quantity(value, input_unit)
+
+        if output_unit is not None:
+            value.convert_to_units(output_unit)
+
+    return format_number(value)
+
+
 def get_if_present_float(dictionary, value: str, input_unit=None, output_unit=None):
     """
     A replacement for .get() that also formats the number if present.
@@ -45,19 +80,13 @@ def get_if_present_float(dictionary, value: str, input_unit=None, output_unit=No
     Assumes data should be a float.
     """
 
-    try:
-        value = float(dictionary[value])
-
-        if input_unit is not None:
-            value = unyt.unyt_quantity(value, input_unit)
+    raw_value = dictionary.get(value)
 
-            if output_unit is not None:
-                value.convert_to_units(output_unit)
-
-        return format_number(value)
-    except KeyError:
+    if raw_value is None:
         return ""
 
+    return _format_quantity(float(raw_value), input_unit, output_unit)
+
 
 def get_if_present_int(dictionary, value: str, input_unit=None, output_unit=None):
     """
@@ -66,24 +95,81 @@ def get_if_present_int(dictionary, value: str, input_unit=None, output_unit=None
     Assumes data should be an integer.
     """
 
-    try:
-        value = int(dictionary[value])
-
-        if input_unit is not None:
-            value = unyt.unyt_quantity(value, input_unit)
-
-            if output_unit is not None:
-                value.convert_to_units(output_unit)
+    raw_value = dictionary.get(value)
 
-        return format_number(value)
-    except KeyError:
+    if raw_value is None:
         return ""
 
+    return _format_quantity(int(raw_value), input_unit, output_unit)
+
 
 def camel_to_title(string):
     return string.title().replace("_", " ")
 
 
+# Location of the compiled templates, alongside the cached histograms.
+template_cache_directory = os.path.join(cache_directory, "jinja")
+
+# Jinja environments shared between all of the webpage creators, keyed by the
+# directory that their templates are loaded from (None for the templates
+# that are part of this package).
+environments: Dict[Optional[str], Environment] = {}
+
+
+def get_environment(directory: Optional[str] = None) -> Environment:
+    """
+    Gets the (shared) ``jinja`` environment for a template directory,
+    setting it up the first time it is requested. Sharing these means that
+    each template is only compiled once per process, and the compiled
+    templates are also kept in ``jinja``'s bytecode cache (in
+    ``template_cache_directory``) between runs.
+
+    Parameters
+    ----------
+
+    directory: str, optional
+        Directory to load the templates from, e.g. the config directory for
+        the run descriptions. Defaults to the templates in this package.
+
+    Returns
+    -------
+
+    environment: Environment
+        Environment with the number formatting filters registered.
+    """
+
+    if directory in environments:
+        return environments[directory]
+
+    if directory is None:
+        loader = PackageLoader("swiftpipeline", "templates")
+        autoescape = select_autoescape(["js"])
+    else:
+        loader = FileSystemLoader(directory)
+        autoescape = False
+
+    # If the cache directory can not be created, the templates are just
+    # compiled every time.
+    try:
+        os.makedirs(template_cache_directory, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(template_cache_directory)
+    except OSError:
+        bytecode_cache = None
+
+    environment = Environment(
+        loader=loader, autoescape=autoescape, bytecode_cache=bytecode_cache
+    )
+
+    environment.filters["format_number"] = format_number
+    environment.filters["camel_to_title"] = camel_to_title
+    environment.filters["get_if_present_float"] = get_if_present_float
+    environment.filters["get_if_present_int"] = get_if_present_int
+
+    environments[directory] = environment
+
+    return environment
+
+
 class WebpageCreator(object):
     """
     Creates webpages based on the information that is provided in
@@ -105,10 +191,8 @@ class WebpageCreator(object):
         Sets up the ``jinja`` templating system.
         """
 
-        self.loader = PackageLoader("swiftpipeline", "templates")
-        self.environment = Environment(
-            loader=self.loader, autoescape=select_autoescape(["js"])
-        )
+        self.environment = get_environment()
+        self.loader = self.environment.loader
 
         # Initialise empty variables dictionary, with the versions of
         # this package and the velociraptor package used.
@@ -142,6 +226,15 @@ class WebpageCreator(object):
             The resulting HTML. This is also stored in ``.html``.
         """
 
+        # Sort the sections by title once here, rather than in each of the
+        # loops over them in the template.
+        self.variables["sections"] = dict(
+            sorted(
+                self.variables["sections"].items(),
+                key=lambda item: item[1]["title"].lower(),
+            )
+        )
+
         self.html = self.environment.get_template(template, parent="base.html").render(
             **self.variables
         )
@@ -161,6 +254,32 @@ class WebpageCreator(object):
 
         self.variables.update(dict(page_name=page_name))
 
+    def __add_plots_to_section(self, section: str, section_id: int, plots: List[Dict]):
+        """
+        Adds plots to the start of a section, creating the section if it does
+        not yet exist. Existing sections are updated in place, rather than
+        being re-built with a new list of plots.
+
+        Parameters
+        ----------
+
+        section: str
+            Title of the section.
+
+        section_id: int
+            Identifier of the section, only used if it is created.
+
+        plots: List[Dict]
+            Plots to add, which are placed before any already in the section.
+        """
+
+        current_section = self.variables["sections"].setdefault(
+            section, dict(title=section, plots=[], id=section_id)
+        )
+        current_section.setdefault("plots", [])[:0] = plots
+
+        return
+
     def add_auto_plotter_metadata(self, auto_plotter_metadata: AutoPlotterMetadata):
         """
         Adds the auto plotter metadata to the section / plot metadata.
@@ -175,34 +294,22 @@ class WebpageCreator(object):
 
         self.auto_plotter_metadata = auto_plotter_metadata
 
-        # Unique sections
-        sections = {
-            plot.section
-            for plot in auto_plotter_metadata.metadata
-            if plot.show_on_webpage
-        }
-
-        for section in sections:
-            plots = [
-                dict(
-                    filename=f"{plot.filename}.{auto_plotter_metadata.file_extension}",
-                    title=plot.title,
-                    caption=plot.caption,
-                    hash=abs(hash(plot.caption + plot.title)),
+        # Group the plots by section in a single pass
+        plots_by_section: Dict[str, List[Dict]] = {}
+
+        for plot in auto_plotter_metadata.metadata:
+            if plot.show_on_webpage:
+                plots_by_section.setdefault(plot.section, []).append(
+                    dict(
+                        filename=f"{plot.filename}.{auto_plotter_metadata.file_extension}",
+                        title=plot.title,
+                        caption=plot.caption,
+                        hash=stable_id(plot.caption, plot.title),
+                    )
                 )
-                for plot in auto_plotter_metadata.metadata
-                if plot.section == section and plot.show_on_webpage
-            ]
 
-            current_section_plots = (
-                self.variables["sections"].get(section, {"plots": []}).get("plots", [])
-            )
-
-            self.variables["sections"][section] = dict(
-                title=section,
-                plots=plots + current_section_plots,
-                id=abs(hash(section)),
-            )
+        for section, plots in plots_by_section.items():
+            self.__add_plots_to_section(section, stable_id(section), plots)
 
         return
 
@@ -223,19 +330,18 @@ class WebpageCreator(object):
 
         self.config = config
 
-        # Unique sections
-        sections = {
-            script.section for script in config.scripts if script.show_on_webpage
-        }
+        for section, scripts in config.scripts_by_section.items():
 
-        scripts_to_use = config.comparison_scripts if is_comparison else config.scripts
-
-        for section in sections:
+            # Only sections with plots to show (in any mode) get a heading
+            if not any(script.show_on_webpage for script in scripts):
+                continue
 
             plots: List[Dict] = []
 
-            for script in scripts_to_use:
-                if script.section == section and script.show_on_webpage:
+            for script in scripts:
+                if script.show_on_webpage and (
+                    script.use_for_comparison or not is_comparison
+                ):
 
                     # Check whether we expect more than one plot (output file) produced by the script
                     if isinstance(script.output_file, list):
@@ -268,7 +374,7 @@ class WebpageCreator(object):
                                 filename=output_file,
                                 title=title,
                                 caption=caption,
-                                hash=abs(hash(caption + output_file)),
+                                hash=stable_id(caption, output_file),
                             )
 
                             # Add collect in a list
@@ -280,19 +386,11 @@ class WebpageCreator(object):
                             filename=script.output_file,
                             title=script.title,
                             caption=script.caption,
-                            hash=abs(hash(script.caption + script.output_file)),
+                            hash=stable_id(script.caption, script.output_file),
                         )
                         plots.append(plot)
 
-            current_section_plots = (
-                self.variables["sections"].get(section, {"plots": []}).get("plots", [])
-            )
-
-            self.variables["sections"][section] = dict(
-                title=section,
-                plots=plots + current_section_plots,
-                id=abs(hash(section)),
-            )
+            self.__add_plots_to_section(section, scripts[0].section_id, plots)
 
         return
 
@@ -310,21 +408,13 @@ class WebpageCreator(object):
             SWIFT Datasets used to generate the HTML with.
         """
 
-        loader = FileSystemLoader(config.config_directory)
-        environment = Environment(loader=loader)
-
-        environment.filters["format_number"] = format_number
-        environment.filters["camel_to_title"] = camel_to_title
-        environment.filters["get_if_present_float"] = get_if_present_float
-        environment.filters["get_if_present_int"] = get_if_present_int
+        environment = get_environment(config.config_directory)
 
         if config.description_template is not None:
+            description_template = environment.get_template(config.description_template)
+
             self.variables["runs"] = [
-                dict(
-                    description=environment.get_template(
-                        config.description_template
-                    ).render(data=data)
-                )
+                dict(description=description_template.render(data=data))
                 for data in snapshots
             ]
 
@@ -346,8 +436,10 @@ class WebpageCreator(object):
             Full filename (including file path) to save the HTML as.
         """
 
-        with open(filename, "w") as handle:
-            handle.write(self.html)
+        # The pages declare themselves as utf-8, so write them as such, in a
+        # single write to a binary file.
+        with open(filename, "wb") as handle:
+            handle.write(self.html.encode("utf-8"))
 
 
 class ImageWebpageCreator(object):
@@ -363,20 +455,24 @@ class ImageWebpageCreator(object):
 
     config: Config
 
+    # Templates for the gallery and the individual halo pages, fetched once.
+    gallery_template: Template
+    halo_template: Template
+
     def __init__(self, haloes, config):
         """
         Sets up the ``jinja`` templating system.
         """
 
-        self.loader = PackageLoader("swiftpipeline", "templates")
-        self.environment = Environment(
-            loader=self.loader, autoescape=select_autoescape(["js"])
-        )
+        self.environment = get_environment()
+        self.loader = self.environment.loader
 
-        self.environment.filters["format_number"] = format_number
-        self.environment.filters["camel_to_title"] = camel_to_title
-        self.environment.filters["get_if_present_float"] = get_if_present_float
-        self.environment.filters["get_if_present_int"] = get_if_present_int
+        self.gallery_template = self.environment.get_template(
+            "image_gallery.html", parent="base.html"
+        )
+        self.halo_template = self.environment.get_template(
+            "image_halo.html", parent="base.html"
+        )
 
         # Initialise empty variables dictionary, with the versions of
         # this package and the velociraptor package used.
@@ -410,31 +506,47 @@ class ImageWebpageCreator(object):
             The resulting HTML. This is also stored in ``.html``.
         """
 
-        self.html = self.environment.get_template(
-            "image_gallery.html", parent="base.html"
-        ).render(page_name="Image Gallery", **self.variables)
+        self.html = self.gallery_template.render(
+            page_name="Image Gallery", **self.variables
+        )
 
         return self.html
 
     def render_single_halo(self, halo) -> str:
-        return self.environment.get_template(
-            "image_halo.html", parent="base.html"
-        ).render(page_name=f"Halo {halo.unique_id}", halo=halo, **self.variables)
+        return self.halo_template.render(
+            page_name=f"Halo {halo.unique_id}", halo=halo, **self.variables
+        )
 
     def save_html(self, output_path: Path):
         """
         Saves all the relevant HTML, to the output path.
         """
 
+        # Build the filenames as plain strings, rather than with a new Path
+        # object for every halo. As for WebpageCreator, the pages are written
+        # as utf-8 through binary files.
+        output_path = os.fspath(output_path)
+
         gallery_html = self.render_gallery()
-        gallery_filename = Path(output_path) / "index.html"
+        gallery_filename = f"{output_path}/index.html"
 
-        with open(gallery_filename, "w") as handle:
-            handle.write(gallery_html)
+        with open(gallery_filename, "wb") as handle:
+            handle.write(gallery_html.encode("utf-8"))
 
-        for halo in self.variables["haloes"]:
+        def save_single_halo(halo):
             halo_html = self.render_single_halo(halo)
-            halo_filename = Path(output_path) / f"halo_{halo.unique_id}/index.html"
+            halo_filename = f"{output_path}/halo_{halo.unique_id}/index.html"
+
+            with open(halo_filename, "wb") as handle:
+                handle.write(halo_html.encode("utf-8"))
+
+            return
 
-            with open(halo_filename, "w") as handle:
-                handle.write(halo_html)
+        # The halo pages are independent, so overlap the writes (templates
+        # are safe to render from several threads). Consuming the results
+        # re-raises any errors from the threads.
+        with ThreadPoolExecutor() as executor:
+            for _ in executor.map(save_single_halo, self.variables["haloes"]):
+                pass
+
+        return
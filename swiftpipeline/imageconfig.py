@@ -2,7 +2,7 @@
 Configuration for imaging creator.
 """
 
-import yaml
+from swiftpipeline.config import load_yaml
 from unyt import unyt_quantity
 from typing import List, Optional
 
@@ -22,6 +22,68 @@ direct_read = {
 }
 
 
+def _to_quantity(value) -> unyt_quantity:
+    """
+    Converts a [value, unit] pair from the yaml file to an unyt_quantity.
+    """
+
+    if isinstance(value, unyt_quantity):
+        return value
+
+    size, unit = value
+
+    return unyt_quantity(float(size), unit)
+
+
+# Functions that convert the items in direct_read to the type of their
+# default, e.g. int for the resolution.
+direct_read_types = {
+    variable: _to_quantity if isinstance(default, unyt_quantity) else type(default)
+    for variable, default in direct_read.items()
+}
+
+# Properties of each image, with their defaults
+image_defaults = {
+    "name": "",
+    "particle_type": "gas",
+    "visualise": "projected_densities",
+    "cmap": "viridis",
+    "text_color": "white",
+    "plot_background_color": "white",
+    "face_on": True,
+    "edge_on": True,
+    "log_norm": True,
+}
+
+# Optional properties of each image that are quantities with units
+image_quantities = ["vmin", "vmax", "fill_below", "output_units"]
+
+
+def _lazy_quantity(name: str) -> property:
+    """
+    Creates a property for the image quantity ``name``, which is only
+    converted from its raw form in the config (either [value, unit] or just
+    a unit) to an unyt_quantity the first time that it is used. Many of
+    these are never used in a given run, and creating them is slow.
+    """
+
+    def get_quantity(self) -> Optional[unyt_quantity]:
+        value = self._quantities[name]
+
+        if value is not None and not isinstance(value, unyt_quantity):
+            if isinstance(value, str):
+                size, unit = 1.0, value
+            else:
+                size, unit = value
+
+            value = unyt_quantity(float(size), unit)
+            self._quantities[name] = value
+
+        return value
+
+    return property(get_quantity)
+
+
 class Image(object):
     """
     Object describing the properties of a given image, implementing
@@ -64,54 +126,33 @@ class Image(object):
     # Logarithmically normalise the image?
     log_norm: bool
 
+    # There is one of these for every image in the config, so avoid giving
+    # each one its own __dict__.
+    __slots__ = ["base_name", "radius_raw", "radius", "_quantities"] + list(
+        image_defaults.keys()
+    )
+
+    vmin = _lazy_quantity("vmin")
+    vmax = _lazy_quantity("vmax")
+    fill_below = _lazy_quantity("fill_below")
+    output_units = _lazy_quantity("output_units")
+
     def __init__(self, base_name: str, image_dict: dict):
         """
         Extracts the dictionary to internal variables
         """
 
         self.base_name = base_name
-        self.name = image_dict.get("name", "")
         self.radius_raw = image_dict.get("radius", None)
-        self.particle_type = image_dict.get("particle_type", "gas")
-        self.visualise = image_dict.get("visualise", "projected_densities")
-        self.vmin, self.vmax = self._unpack_vminmax(image_dict)
-        self.fill_below = self._unpack_fill_below(image_dict)
-        self.output_units = self._unpack_output_units(image_dict)
-        self.cmap = image_dict.get("cmap", "viridis")
-        self.text_color = image_dict.get("text_color", "white")
-        self.plot_background_color = image_dict.get("plot_background_color", "white")
-        self.face_on = bool(image_dict.get("face_on", True))
-        self.edge_on = bool(image_dict.get("edge_on", True))
-        self.log_norm = bool(image_dict.get("log_norm", True))
-
-    def _unyt_from_dict_item(self, name, image_dict):
-        """
-        Extracts an unyt_quantity from items.
-        """
-
-        raw_possible = image_dict.get(name, None)
-
-        if raw_possible is not None:
-            try:
-                size, unit = raw_possible
-            except ValueError:
-                size = 1.0
-                unit = raw_possible
-
-            raw_possible = unyt_quantity(float(size), unit)
 
-        return raw_possible
+        for variable, default in image_defaults.items():
+            value = image_dict.get(variable, default)
+            setattr(self, variable, bool(value) if isinstance(default, bool) else value)
 
-    def _unpack_vminmax(self, image_dict):
-        vmin = self._unyt_from_dict_item(name="vmin", image_dict=image_dict)
-        vmax = self._unyt_from_dict_item(name="vmax", image_dict=image_dict)
-        return vmin, vmax
-
-    def _unpack_fill_below(self, image_dict):
-        return self._unyt_from_dict_item(name="fill_below", image_dict=image_dict)
-
-    def _unpack_output_units(self, image_dict):
-        return self._unyt_from_dict_item(name="output_units", image_dict=image_dict)
+        # Raw values, converted on first use by the properties above
+        self._quantities = {
+            variable: image_dict.get(variable, None) for variable in image_quantities
+        }
 
     def get_radius(
         self, stellar_half_mass: unyt_quantity, r_200_crit: unyt_quantity
@@ -140,21 +181,23 @@ class Image(object):
         """
 
         if self.radius_raw is None:
-            raise AttributeError(f"You must specify a radius for image {name}.")
+            raise AttributeError(
+                f"You must specify a radius for image {self.base_name}."
+            )
 
         value, units = self.radius_raw
 
+        # Only compare the (string) units from the config, rather than
+        # comparing strings against quantities.
         if units == "stellar_half_mass":
-            units = stellar_half_mass
-
-            if units == 0.0:
-                # Big mistake - fall back on r_200_crit
-                units = r_200_crit
-
-        if units == "r_200_crit":
-            units = r_200_crit
+            # Big mistake if it is zero - fall back on r_200_crit
+            scale = stellar_half_mass if stellar_half_mass != 0.0 else r_200_crit
+        elif units == "r_200_crit":
+            scale = r_200_crit
+        else:
+            return unyt_quantity(float(value), units)
 
-        return unyt_quantity(float(value), units)
+        return float(value) * scale
 
 
 class ImageConfig(object):
@@ -205,8 +248,7 @@ class ImageConfig(object):
         ``self.raw_config``.
         """
 
-        with open(f"{self.config_directory}/images.yml", "r") as handle:
-            self.raw_config = yaml.safe_load(handle)
+        self.raw_config = load_yaml(f"{self.config_directory}/images.yml")
 
         return
 
@@ -216,15 +258,8 @@ class ImageConfig(object):
         """
 
         for variable, default in direct_read.items():
-            try:
-                setattr(
-                    self,
-                    variable,
-                    type(default)(self.raw_config.get(variable, default)),
-                )
-            except RuntimeError:
-                value, unit = self.raw_config.get(variable, default)
-                setattr(self, variable, unyt_quantity(float(value), unit))
+            value = self.raw_config.get(variable, default)
+            setattr(self, variable, direct_read_types[variable](value))
 
         return
 
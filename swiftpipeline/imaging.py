@@ -9,14 +9,18 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from tqdm import tqdm
-from p_tqdm import p_map
 
-from matplotlib.colors import LogNorm, Normalize
+from matplotlib.colors import LogNorm, Normalize, to_rgba
 from matplotlib.patches import Circle
+from matplotlib.cm import ScalarMappable
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 from unyt import unyt_quantity, unyt_array
 
+from PIL import Image as PILImage
+
 from swiftsimio.visualisation.projection import project_pixel_grid
 from swiftsimio.visualisation.slice import kernel_gamma
 from swiftsimio.visualisation.smoothing_length_generation import (
@@ -27,9 +31,15 @@ from swiftsimio.visualisation.rotation import rotation_matrix_from_vector
 from swiftsimio import load, mask, SWIFTDataset
 from velociraptor import load as load_catalogue
 from swiftpipeline.html import ImageWebpageCreator
+from swiftpipeline.haloselection import subsample_bins, group_nested_regions
 
 from pathlib import Path
 from enum import Enum, auto
+from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from threading import local
+from os import cpu_count
 
 from typing import Optional, List
 
@@ -66,6 +76,9 @@ class Halo(object):
     unique_id: int
     position: unyt_array
     L: unyt_array
+    mass_200_crit_latex: str
+    mass_100_kpc_star_latex: str
+    rotation_matrices: dict
 
     def __init__(
         self,
@@ -83,11 +96,88 @@ class Halo(object):
         self.mass_100_kpc_star = mass_100_kpc_star
         self.radius_100_kpc_star = radius_100_kpc_star
         self.unique_id = unique_id
-        self.position = unyt_array(position, position[0].units)
-        self.L = unyt_array(L, L[0].units)
+
+        # Lists of quantities must be converted to arrays, but arrays (as
+        # created by haloes_to_visualise) can be used as they are.
+        if not isinstance(position, unyt_array):
+            position = unyt_array(position, position[0].units)
+
+        if not isinstance(L, unyt_array):
+            L = unyt_array(L, L[0].units)
+
+        self.position = position
+        self.L = L
+
+        # These label every figure made for this halo, so only format
+        # them once.
+        self.mass_200_crit_latex = latex_float(mass_200_crit.to("Solar_Mass"))
+        self.mass_100_kpc_star_latex = latex_float(mass_100_kpc_star.to("Solar_Mass"))
+
+        self.rotation_matrices = {}
 
         return
 
+    def get_rotation_matrix(self, axis: str) -> np.array:
+        """
+        Gets the rotation matrix that aligns the angular momentum of the
+        halo with the given axis. These are only calculated once, as they
+        are shared by all of the images of the halo.
+
+        Parameters
+        ----------
+
+        axis: str
+            Axis to align the angular momentum with, "y" for an edge-on
+            projection and "z" for a face-on projection.
+
+        Returns
+        -------
+
+        rotation_matrix: np.array
+            The 3x3 rotation matrix.
+        """
+
+        if axis not in self.rotation_matrices:
+            # If the L vector is poorly constrained this will complain,
+            # but we don't really care. Unlike the warnings filters, the
+            # error state is per thread.
+            with np.errstate(divide="ignore", invalid="ignore"):
+                self.rotation_matrices[axis] = rotation_matrix_from_vector(
+                    self.L.v, axis
+                )
+
+        return self.rotation_matrices[axis]
+
+    def get_region(self, radius: unyt_quantity, dimensions: int = 3) -> unyt_array:
+        """
+        Gets the edges of the cube (or square) of half-width ``radius``
+        around the halo.
+
+        Parameters
+        ----------
+
+        radius: unyt_quantity
+            Half-width of the region.
+
+        dimensions: int, optional
+            Number of dimensions to give the edges along, two for the
+            extent of an image. Default: 3.
+
+        Returns
+        -------
+
+        region: unyt_array
+            Edges of the region, [x_min, x_max, y_min, y_max, ...].
+        """
+
+        units = self.position.units
+        signs = np.tile([-1.0, 1.0], dimensions)
+
+        return unyt_array(
+            np.repeat(self.position.v[:dimensions], 2) + signs * radius.to(units).v,
+            units,
+        )
+
 
 def haloes_to_visualise(config: ImageConfig, catalogue_path: Path) -> List[Halo]:
     """
@@ -142,25 +232,11 @@ def haloes_to_visualise(config: ImageConfig, catalogue_path: Path) -> List[Halo]
         # we cannot use bin 0 as this is haloes below our minimum mass (which
         # should not be present, see the mask above).
 
-        mass_mask = np.zeros(len(digitized), dtype=bool)
-
-        # This loop can definitely be optimised.
-        for bin_id in range(1, len(bins) + 1):
-            matches = digitized == bin_id
-            number_of_matches = matches.sum()
-
-            # If there's too many, we must sub-sample randomly.
-            if number_of_matches > config.haloes_to_visualise_per_bin:
-                choices = rng.choice(
-                    number_of_matches,
-                    size=config.haloes_to_visualise_per_bin,
-                    replace=False,
-                )
-
-                mass_mask[np.where(matches)[0][choices]] = True
-
-            else:
-                mass_mask[matches] = True
+        mass_mask = subsample_bins(
+            digitized=digitized,
+            maximum_per_bin=config.haloes_to_visualise_per_bin,
+            rng=rng,
+        )
 
         # Modify our original mask with our new changes
         mask[mask] = mass_mask
@@ -168,32 +244,43 @@ def haloes_to_visualise(config: ImageConfig, catalogue_path: Path) -> List[Halo]
     # Now build the list of halo objects from valid objects, starting
     # with the most massive.
 
-    haloes = []
     halo_id_order = np.argsort(mass_200crit[mask])[::-1]
     halo_ids_valid = np.arange(len(mass_200crit))[mask][halo_id_order]
 
-    for unique_id in halo_ids_valid:
-        haloes.append(
-            Halo(
-                mass_200_crit=catalogue.masses.mass_200crit[unique_id],
-                radius_200_crit=catalogue.radii.r_200crit[unique_id] / a,
-                mass_100_kpc_star=catalogue.apertures.mass_star_100_kpc[unique_id],
-                radius_100_kpc_star=catalogue.apertures.rhalfmass_star_100_kpc[
-                    unique_id
-                ]
-                / a,
-                unique_id=unique_id,
-                position=[
-                    getattr(catalogue.positions, f"{c}cmbp")[unique_id] / a
-                    for c in "xyz"
-                ],
-                L=[
-                    getattr(catalogue.angular_momentum, f"l{c}_star")[unique_id]
-                    for c in "xyz"
-                ],
-            )
+    # Read each property for all of the valid haloes at once, rather than
+    # indexing the catalogue arrays one halo at a time.
+    def stack_components(arrays):
+        units = arrays[0].units
+        return unyt_array(
+            np.stack([array[halo_ids_valid].to(units).v for array in arrays], axis=1),
+            units,
         )
 
+    positions = (
+        stack_components([getattr(catalogue.positions, f"{c}cmbp") for c in "xyz"]) / a
+    )
+    angular_momenta = stack_components(
+        [getattr(catalogue.angular_momentum, f"l{c}_star") for c in "xyz"]
+    )
+
+    masses_200_crit = catalogue.masses.mass_200crit[halo_ids_valid]
+    radii_200_crit = catalogue.radii.r_200crit[halo_ids_valid] / a
+    masses_100_kpc_star = catalogue.apertures.mass_star_100_kpc[halo_ids_valid]
+    radii_100_kpc_star = catalogue.apertures.rhalfmass_star_100_kpc[halo_ids_valid] / a
+
+    haloes = [
+        Halo(
+            mass_200_crit=masses_200_crit[index],
+            radius_200_crit=radii_200_crit[index],
+            mass_100_kpc_star=masses_100_kpc_star[index],
+            radius_100_kpc_star=radii_100_kpc_star[index],
+            unique_id=unique_id,
+            position=positions[index],
+            L=angular_momenta[index],
+        )
+        for index, unique_id in enumerate(halo_ids_valid)
+    ]
+
     return haloes
 
 
@@ -203,6 +290,9 @@ def create_scatter(
     image: Image,
     projection: Projection,
     resolution: int,
+    radius: unyt_quantity,
+    boxsize: unyt_array,
+    mask: Optional[np.array] = None,
 ) -> unyt_array:
     """
     Creates a projected image for a given image class, and snapshot.
@@ -225,6 +315,16 @@ def create_scatter(
     resolution: int
         Image size along each axis.
 
+    radius: unyt_quantity
+        Half-width of the image, as given by ``image.get_radius``.
+
+    boxsize: unyt_array
+        Size of the simulation box, from the snapshot metadata.
+
+    mask: np.array, optional
+        Boolean mask of the particles (of ``image.particle_type``) to
+        project, e.g. from ``halo_particle_mask``. Default: all of them.
+
     Returns
     -------
 
@@ -232,36 +332,19 @@ def create_scatter(
         Output grid, in the requested units.
     """
 
-    region_given_r = lambda r: [
-        halo.position[0] - r,
-        halo.position[0] + r,
-        halo.position[1] - r,
-        halo.position[1] + r,
-        halo.position[2] - r,
-        halo.position[2] + r,
-    ]
-
-    radius = image.get_radius(
-        stellar_half_mass=halo.radius_100_kpc_star, r_200_crit=halo.radius_200_crit
-    )
-
     particle_data = getattr(snapshot, image.particle_type, "gas")
 
-    region = region_given_r(radius)
+    region = halo.get_region(radius)
 
     rotation_center = None
     rotation_matrix = None
 
-    # If the L vector is poorly constrained this will complain,
-    # but we don't really care.
-    with np.testing.suppress_warnings() as sup:
-        sup.filter(RuntimeWarning)
-        if projection == Projection.EDGE_ON:
-            rotation_center = halo.position.to(particle_data.coordinates.units)
-            rotation_matrix = rotation_matrix_from_vector(halo.L.v, "y")
-        elif projection == Projection.FACE_ON:
-            rotation_center = halo.position.to(particle_data.coordinates.units)
-            rotation_matrix = rotation_matrix_from_vector(halo.L.v, "z")
+    if projection == Projection.EDGE_ON:
+        rotation_center = halo.position.to(particle_data.coordinates.units)
+        rotation_matrix = halo.get_rotation_matrix("y")
+    elif projection == Projection.FACE_ON:
+        rotation_center = halo.position.to(particle_data.coordinates.units)
+        rotation_matrix = halo.get_rotation_matrix("z")
 
     if hasattr(particle_data, "smoothing_lengths"):
         backend = "fast"
@@ -270,17 +353,39 @@ def create_scatter(
 
     common_attributes = dict(
         data=particle_data,
-        boxsize=snapshot.metadata.boxsize,
+        boxsize=boxsize,
         resolution=resolution,
         region=region,
-        mask=None,
+        mask=mask,
         rotation_matrix=rotation_matrix,
         rotation_center=rotation_center,
         parallel=False,
         backend=backend,
     )
 
-    mass_image = project_pixel_grid(project="masses", **common_attributes)
+    # The mass projection is the same for every image of this particle
+    # type with the same radius and projection (it is the denominator of
+    # all of the mass-weighted images), so only make it once. The data may
+    # be shared between several haloes, so these are keyed by halo too.
+    mass_image_cache = getattr(particle_data, "_CACHE_MASSIMAGE_", None)
+
+    if mass_image_cache is None:
+        mass_image_cache = {}
+
+        setattr(particle_data, "_CACHE_MASSIMAGE_", mass_image_cache)
+
+    mass_image_key = (
+        halo.unique_id,
+        projection,
+        resolution,
+        float(radius.to(halo.position.units).v),
+    )
+    mass_image = mass_image_cache.get(mass_image_key, None)
+
+    if mass_image is None:
+        mass_image = project_pixel_grid(project="masses", **common_attributes)
+
+        mass_image_cache[mass_image_key] = mass_image
 
     if image.visualise == "projected_densities":
         # We're done!
@@ -290,7 +395,8 @@ def create_scatter(
         units.convert_to_units(1.0 / (x_range.units * y_range.units))
         units *= particle_data.masses.units
 
-        grid = unyt_array(mass_image, units=units)
+        # Copy, as the grid is modified in-place below.
+        grid = unyt_array(mass_image.copy(), units=units)
     else:
         # Need to make the complementary image.
         cache_name = f"_CACHE_MASSWEIGHTED_{image.visualise}"
@@ -298,40 +404,147 @@ def create_scatter(
         particle_array = getattr(particle_data, image.visualise)
 
         if cache is None:
-            cache = particle_array * particle_data.masses
+            # Multiply the raw values, rather than the unyt arrays, which
+            # would also convert the result to unscaled units (e.g. from
+            # K * 1e10 Msun to K * Msun) in a second pass over the array.
+            cache = unyt_array(
+                np.multiply(particle_array.d, particle_data.masses.d),
+                units=particle_array.units * particle_data.masses.units,
+            )
 
             setattr(particle_data, cache_name, cache)
 
         weighted_image = project_pixel_grid(project=cache_name, **common_attributes)
 
-        # Deal with zeroes:
-        mass_image[mass_image == 0.0] = 1.0
+        # Divide in-place, leaving pixels without any mass as they are (as
+        # if their mass were one). This leaves the cached mass image as-is.
+        np.divide(
+            weighted_image, mass_image, out=weighted_image, where=mass_image != 0.0
+        )
 
-        # K * 1e10 Msun -> K * Msun for the 'units' internally. So we need
-        # to reconstruct the true ratio, although this should be ideally the
-        # same as particle_array.units.
+        # The projections are of the raw values, so reconstruct the units
+        # of the ratio, although this should be ideally the same as
+        # particle_array.units.
         units = cache.units / particle_data.masses.units
 
-        grid = unyt_array(weighted_image / mass_image, units=units)
+        grid = unyt_array(weighted_image, units=units)
 
-    # Fill if required
-    output_units = None
-    unit_steal = [image.output_units, image.vmin, image.vmax, grid]
-
-    while output_units is None:
-        potential_unit = unit_steal.pop(0)
-        if potential_unit is not None:
-            output_units = potential_unit.units
+    # The output units are taken from the first of these that is set (the
+    # grid itself always is).
+    output_units = next(
+        x.units
+        for x in [image.output_units, image.vmin, image.vmax, grid]
+        if x is not None
+    )
 
     grid.convert_to_units(output_units)
 
+    # Fill if required
     if image.fill_below is not None:
-        mask = grid < image.fill_below.to(output_units)
-        grid[mask] = image.fill_below.to(output_units)
+        # Clip in-place on the underlying data (.d is a view, unlike .v).
+        np.maximum(grid.d, image.fill_below.to(output_units).v, out=grid.d)
 
     return grid
 
 
+def create_norm(image: Image, units) -> Normalize:
+    """
+    Creates the colour map normalisation for an image.
+
+    Parameters
+    ----------
+
+    image: Image
+        Image class to visualise this time around
+
+    units: unyt.Unit
+        Units of the scattered image.
+
+    Returns
+    -------
+
+    norm: Normalize
+        Normalisation, logarithmic if requested by the image.
+    """
+
+    vmin = image.vmin.to(units) if image.vmin is not None else None
+    vmax = image.vmax.to(units) if image.vmax is not None else None
+
+    if image.log_norm:
+        return LogNorm(vmin=vmin, vmax=vmax, clip=True)
+    else:
+        return Normalize(vmin=vmin, vmax=vmax, clip=True)
+
+
+# Figures (and their axes) re-used between calls to get_figure, keyed by
+# their size and resolution. Each thread has its own, as a figure can
+# only be drawn by one thread at a time.
+figure_cache = local()
+
+
+def get_figure(figure_size: float, dpi: int):
+    """
+    Returns an empty figure for an image, with axes filling the figure
+    and a second set of axes for the colour bar along the top.
+
+    Creating a figure takes far longer than drawing an image, so the
+    same figure is cleared and handed out again on every call from the
+    same thread with the same size and resolution. It must not be closed
+    by the caller.
+
+    Parameters
+    ----------
+
+    figure_size: float
+        Width and height of the figure in inches.
+
+    dpi: int
+        Resolution of the figure.
+
+    Returns
+    -------
+
+    fig: Figure
+        The figure.
+
+    ax: Axes
+        Axes to draw the image in.
+
+    color_bar_ax: Axes
+        Axes to draw the colour bar in.
+    """
+
+    key = (figure_size, dpi)
+    figures = getattr(figure_cache, "figures", None)
+
+    if figures is None:
+        figures = {}
+        figure_cache.figures = figures
+
+    if key in figures:
+        fig, ax, color_bar_ax = figures[key]
+
+        ax.clear()
+        color_bar_ax.clear()
+    else:
+        # These figures are only ever saved, so give them an Agg canvas
+        # directly rather than going through pyplot and its backend (and
+        # its list of open figures).
+        fig = Figure(figsize=[figure_size] * 2, dpi=dpi)
+        FigureCanvasAgg(fig)
+
+        ax = fig.add_subplot()
+        fig.subplots_adjust(0, 0, 1, 1, 0, 0)
+
+        color_bar_ax = fig.add_axes([0.05, 0.95, 0.9, 0.03])
+
+        figures[key] = (fig, ax, color_bar_ax)
+
+    ax.axis("off")
+
+    return fig, ax, color_bar_ax
+
+
 def save_figure_from_scatter(
     scatter: unyt_array,
     config: ImageConfig,
@@ -339,6 +552,10 @@ def save_figure_from_scatter(
     image: Image,
     projection: Projection,
     output_path: Path,
+    radius: unyt_quantity,
+    extent: unyt_array,
+    norm: Normalize,
+    normalised_scatter: np.ma.MaskedArray,
 ):
     """
 
@@ -364,6 +581,18 @@ def save_figure_from_scatter(
 
     output_path: Path
         Path to save the figure at
+
+    radius: unyt_quantity
+        Half-width of the image, as given by ``image.get_radius``.
+
+    extent: unyt_array
+        Edges of the image, [left, right, bottom, top].
+
+    norm: Normalize
+        Normalisation of the image, from ``create_norm``.
+
+    normalised_scatter: np.ma.MaskedArray
+        The transpose of the scatter, already normalised by ``norm``.
     """
 
     output_filename = (
@@ -371,45 +600,26 @@ def save_figure_from_scatter(
         / f"{image.base_name}_{projection.name.lower()}.{config.image_format}"
     )
 
-    fig, ax = plt.subplots(
-        figsize=[config.figure_size] * 2,
-        dpi=config.resolution // config.figure_size,
-        constrained_layout=False,
-        tight_layout=False,
+    fig, ax, color_bar_ax = get_figure(
+        figure_size=config.figure_size, dpi=config.resolution // config.figure_size
     )
 
-    fig.subplots_adjust(0, 0, 1, 1, 0, 0)
-    ax.axis("off")
-
-    vmin = image.vmin.to(scatter.units) if image.vmin is not None else None
-    vmax = image.vmax.to(scatter.units) if image.vmax is not None else None
-
-    if image.log_norm:
-        norm = LogNorm(vmin=vmin, vmax=vmax, clip=True)
-    else:
-        norm = Normalize(vmin=vmin, vmax=vmax, clip=True)
-
-    radius = image.get_radius(
-        stellar_half_mass=halo.radius_100_kpc_star, r_200_crit=halo.radius_200_crit
-    )
-
-    extent_given_r = lambda r: [
-        halo.position[0] - r,
-        halo.position[0] + r,
-        halo.position[1] - r,
-        halo.position[1] + r,
-    ]
-
-    extent = extent_given_r(radius)
-
-    imshow = ax.imshow(
-        scatter.v.T, origin="lower", norm=norm, cmap=image.cmap, extent=extent
+    # The scatter has already been normalised (and is shared with the
+    # thumbnail), so the colour bar is given the original normalisation.
+    ax.imshow(
+        normalised_scatter,
+        origin="lower",
+        vmin=0.0,
+        vmax=1.0,
+        cmap=image.cmap,
+        extent=extent,
     )
 
-    color_bar_ax = fig.add_axes([0.05, 0.95, 0.9, 0.03])
-
     color_bar = fig.colorbar(
-        mappable=imshow, ax=ax, cax=color_bar_ax, orientation="horizontal"
+        mappable=ScalarMappable(norm=norm, cmap=image.cmap),
+        ax=ax,
+        cax=color_bar_ax,
+        orientation="horizontal",
     )
 
     color_bar_label = image.visualise.title().replace("_", " ")
@@ -455,8 +665,8 @@ def save_figure_from_scatter(
         0.975,
         0.025,
         (
-            f"$M_{{\\rm 200, crit}}$={latex_float(halo.mass_200_crit.to('Solar_Mass'))}\n"
-            f"$M_{{*, 100}}$={latex_float(halo.mass_100_kpc_star.to('Solar_Mass'))}"
+            f"$M_{{\\rm 200, crit}}$={halo.mass_200_crit_latex}\n"
+            f"$M_{{*, 100}}$={halo.mass_100_kpc_star_latex}"
         ),
         color=image.text_color,
         ha="right",
@@ -466,18 +676,14 @@ def save_figure_from_scatter(
 
     fig.savefig(output_filename)
 
-    plt.close(fig)
-
     return
 
 
 def save_thumbnail_from_scatter(
-    scatter: unyt_array,
     config: ImageConfig,
-    halo: Halo,
     image: Image,
-    projection: Projection,
     output_path: Path,
+    normalised_scatter: np.ma.MaskedArray,
 ):
     """
 
@@ -487,120 +693,183 @@ def save_thumbnail_from_scatter(
     Parameters
     ----------
 
-    scatter: unyt_array,
-        Array of the scattered image.
-
     config: ImageConfig
         The global image configuration.
 
-    halo: Halo
-        Halo with properties to visualise
-
     image: Image
         Image class to visualise this time around
 
-    projection: Projection
-        Which projection to make
-
     output_path: Path
         Path to save the figure at
+
+    normalised_scatter: np.ma.MaskedArray
+        The transpose of the scatter, already normalised to between zero
+        and one by ``create_norm``.
     """
 
     output_filename = output_path / f"thumbnail.{config.image_format}"
 
-    fig, ax = plt.subplots(
-        figsize=[1] * 2, dpi=128, constrained_layout=False, tight_layout=False
+    # The thumbnail has no decorations, so rather than drawing a whole
+    # figure, colour the pixels directly and shrink them to 128 x 128.
+    # Rows are flipped as the image has its origin at the bottom left.
+    pixels = plt.get_cmap(image.cmap)(normalised_scatter[::-1], bytes=True)
+
+    thumbnail = PILImage.fromarray(pixels).resize((128, 128), resample=PILImage.LANCZOS)
+
+    # As in a figure, masked pixels show the background colour.
+    background_color = to_rgba(plt.rcParams["figure.facecolor"], alpha=1.0)
+    background = PILImage.new(
+        "RGBA", thumbnail.size, tuple(int(255 * x) for x in background_color)
     )
 
-    fig.subplots_adjust(0, 0, 1, 1, 0, 0)
-    ax.axis("off")
+    PILImage.alpha_composite(background, thumbnail).convert("RGB").save(output_filename)
 
-    vmin = image.vmin.to(scatter.units) if image.vmin is not None else None
-    vmax = image.vmax.to(scatter.units) if image.vmax is not None else None
+    return
 
-    if image.log_norm:
-        norm = LogNorm(vmin=vmin, vmax=vmax, clip=True)
-    else:
-        norm = Normalize(vmin=vmin, vmax=vmax, clip=True)
 
-    radius = image.get_radius(
-        stellar_half_mass=halo.radius_100_kpc_star, r_200_crit=halo.radius_200_crit
-    )
+def halo_particle_mask(
+    particle_data, halo: Halo, radius: unyt_quantity, boxsize: unyt_array
+) -> np.array:
+    """
+    Finds the particles inside the cube of half-width ``radius`` around a
+    halo, or whose smoothing kernel reaches into it.
 
-    extent_given_r = lambda r: [
-        halo.position[0] - r,
-        halo.position[0] + r,
-        halo.position[1] - r,
-        halo.position[1] + r,
-    ]
+    Parameters
+    ----------
 
-    extent = extent_given_r(radius)
+    particle_data
+        Particle dataset (e.g. ``data.gas``) to select from.
 
-    ax.imshow(scatter.v.T, origin="lower", norm=norm, cmap=image.cmap, extent=extent)
+    halo: Halo
+        The halo to select the particles around.
 
-    fig.savefig(output_filename)
+    radius: unyt_quantity
+        Half-width of the cube, usually the largest image radius.
 
-    plt.close(fig)
+    boxsize: unyt_array
+        Size of the simulation box, used to wrap the particle offsets.
 
-    return
+    Returns
+    -------
 
+    mask: np.array
+        Boolean mask, true for the selected particles.
+    """
 
-def visualise_halo(
-    output_path: Path, snapshot_path: Path, config: ImageConfig, halo: Halo
-):
+    units = particle_data.coordinates.units
+
+    box = boxsize.to(units).v
+    offsets = np.abs(particle_data.coordinates.to(units).v - halo.position.to(units).v)
+    offsets = np.minimum(offsets, box - offsets)
+    reach = np.full(len(offsets), radius.to(units).v)
+
+    if hasattr(particle_data, "smoothing_lengths"):
+        reach += kernel_gamma * particle_data.smoothing_lengths.to(units).v
+
+    return (offsets <= reach[:, None]).all(axis=1)
+
+
+def clear_caches(particle_data):
     """
-    Creates all of the visualisations in the config for the
-    specified halo, and saves them to disk.
+    Removes the cached arrays and projections created by ``create_scatter``
+    from a set of particle data, freeing their memory.
 
     Parameters
     ----------
 
-    output_path: Path, str
-        Output path to save images to. Inside this path, there will be
-        a number of directories created (one per halo). This path must
-        already exist.
+    particle_data
+        Particle dataset (e.g. ``data.gas``) to clear. May be ``None``,
+        in which case nothing is done.
+    """
+
+    for name in [x for x in dir(particle_data) if x.startswith("_CACHE_")]:
+        delattr(particle_data, name)
+
+    return
 
-    snapshot_path: Path,
-        Path to the snapshot. For a sufficiently large volume, and
-        a sufficiently small number of haloes, there will be little-to
-        -no overlap in the read regions.
+
+def image_radii(config: ImageConfig, halo: Halo) -> List[unyt_quantity]:
+    """
+    Finds the radius of each of the images for a given halo.
+
+    Parameters
+    ----------
 
     config: ImageConfig
         Opened configuration file.
 
     halo: Halo
-        The halo to read the data for and visualise.
+        The halo to find the image radii for.
+
+    Returns
+    -------
+
+    radii: List[unyt_quantity]
+        Radius of each image in ``config.images``.
     """
 
-    # First need to find the maximum radius, amongst any
-    # of the images.
-    radii = [
+    return [
         image.get_radius(
             stellar_half_mass=halo.radius_100_kpc_star, r_200_crit=halo.radius_200_crit
         )
         for image in config.images
     ]
 
-    max_radius = max(radii)
 
-    extent_given_r = lambda r: [
-        [halo.position[x] - r, halo.position[x] + r] for x in range(3)
-    ]
+def load_halo_data(
+    snapshot_path: Path, config: ImageConfig, halo: Halo
+) -> SWIFTDataset:
+    """
+    Reads the particles around a halo, out to the largest radius of any
+    of the images, and generates smoothing lengths if required.
+
+    Parameters
+    ----------
+
+    snapshot_path: Path,
+        Path to the snapshot.
+
+    config: ImageConfig
+        Opened configuration file.
+
+    halo: Halo
+        The halo to read the data for.
+
+    Returns
+    -------
+
+    data: SWIFTDataset
+        The opened dataset, restricted to the region around the halo.
+    """
+
+    # First need to find the maximum radius, amongst any
+    # of the images.
+    max_radius = max(image_radii(config=config, halo=halo))
 
     halo_mask = mask(filename=snapshot_path, spatial_only=True)
-    halo_mask.constrain_spatial(restrict=extent_given_r(max_radius))
+    halo_mask.constrain_spatial(restrict=halo.get_region(max_radius).reshape(3, 2))
 
     data = load(filename=snapshot_path, mask=halo_mask)
 
-    # Generate the smoothing lengths if required.
-    if config.calculate_dark_matter_smoothing_lengths:
+    # Generate the smoothing lengths if required, and only for the particle
+    # types that are actually imaged.
+    particle_types = {image.particle_type for image in config.images}
+
+    if (
+        config.calculate_dark_matter_smoothing_lengths
+        and "dark_matter" in particle_types
+    ):
         data.dark_matter.smoothing_lengths = generate_smoothing_lengths(
             coordinates=data.dark_matter.coordinates,
             boxsize=data.metadata.boxsize,
             kernel_gamma=kernel_gamma,
         )
 
-    if config.recalculate_stellar_smoothing_lengths and hasattr(data, "stars"):
+    if (
+        config.recalculate_stellar_smoothing_lengths
+        and "stars" in particle_types
+        and hasattr(data, "stars")
+    ):
         if len(data.stars.coordinates) > 0:
             data.stars.smoothing_lengths = generate_smoothing_lengths(
                 coordinates=data.stars.coordinates,
@@ -608,50 +877,252 @@ def visualise_halo(
                 kernel_gamma=kernel_gamma,
             )
 
-    halo_directory = output_path / f"halo_{halo.unique_id}"
-    halo_directory.mkdir(exist_ok=True)
+    return data
 
-    for image in config.images:
-        # Which projections should we make?
-        projections = [Projection.DEFAULT]
 
-        if image.face_on:
-            projections.append(Projection.FACE_ON)
+def visualise_halo(
+    output_path: Path,
+    snapshot_path: Path,
+    config: ImageConfig,
+    halo: Halo,
+    data: Optional[SWIFTDataset] = None,
+    mask_particles: bool = False,
+):
+    """
+    Creates all of the visualisations in the config for the
+    specified halo, and saves them to disk.
 
-        if image.edge_on:
-            projections.append(Projection.EDGE_ON)
+    Parameters
+    ----------
 
-        for projection in projections:
-            scatter = create_scatter(
-                snapshot=data,
-                halo=halo,
-                image=image,
-                projection=projection,
-                resolution=config.resolution,
-            )
+    output_path: Path, str
+        Output path to save images to. Inside this path, there will be
+        a number of directories created (one per halo). This path must
+        already exist.
 
-            save_figure_from_scatter(
-                scatter=scatter,
-                config=config,
+    snapshot_path: Path,
+        Path to the snapshot. For a sufficiently large volume, and
+        a sufficiently small number of haloes, there will be little-to
+        -no overlap in the read regions.
+
+    config: ImageConfig
+        Opened configuration file.
+
+    halo: Halo
+        The halo to read the data for and visualise.
+
+    data: SWIFTDataset, optional
+        Already opened dataset containing (at least) the region around
+        this halo, e.g. from ``load_halo_data`` for a larger neighbouring
+        halo. If not given, the data is read from ``snapshot_path``.
+
+    mask_particles: bool, optional
+        Whether to only project the particles in (or whose kernels reach
+        into) this halo's own read region. This should be set when ``data``
+        was read for a larger halo, as otherwise every image of this halo
+        would process (and, in projection, include along the line of sight)
+        all of the particles of that larger region. Default: False.
+    """
+
+    radii = image_radii(config=config, halo=halo)
+
+    if data is None:
+        data = load_halo_data(snapshot_path=snapshot_path, config=config, halo=halo)
+
+    boxsize = data.metadata.boxsize
+
+    halo_directory = output_path / f"halo_{halo.unique_id}"
+    halo_directory.mkdir(exist_ok=True)
+
+    # Make all of the images of one particle type (and, within that, of
+    # the same size) together, so that the cached projections can be
+    # re-used and then freed before moving on to the next type.
+    images_and_radii = sorted(
+        zip(config.images, radii),
+        key=lambda x: (x[0].particle_type, float(x[1].to(halo.position.units))),
+    )
+
+    for particle_type, images_of_type in groupby(
+        images_and_radii, key=lambda x: x[0].particle_type
+    ):
+        if mask_particles:
+            particle_mask = halo_particle_mask(
+                particle_data=getattr(data, particle_type),
                 halo=halo,
-                image=image,
-                projection=projection,
-                output_path=halo_directory,
+                radius=max(radii),
+                boxsize=boxsize,
             )
+        else:
+            particle_mask = None
+
+        for image, radius in images_of_type:
+            extent = halo.get_region(radius, dimensions=2)
 
-            if (
-                projection == Projection.DEFAULT
-                and image.base_name == config.thumbnail_image
-            ):
-                save_thumbnail_from_scatter(
+            # Which projections should we make?
+            projections = [Projection.DEFAULT]
+
+            if image.face_on:
+                projections.append(Projection.FACE_ON)
+
+            if image.edge_on:
+                projections.append(Projection.EDGE_ON)
+
+            for projection in projections:
+                scatter = create_scatter(
+                    snapshot=data,
+                    halo=halo,
+                    image=image,
+                    projection=projection,
+                    resolution=config.resolution,
+                    radius=radius,
+                    boxsize=boxsize,
+                    mask=particle_mask,
+                )
+
+                norm = create_norm(image=image, units=scatter.units)
+                normalised_scatter = norm(scatter.v.T)
+
+                save_figure_from_scatter(
                     scatter=scatter,
                     config=config,
                     halo=halo,
                     image=image,
                     projection=projection,
                     output_path=halo_directory,
+                    radius=radius,
+                    extent=extent,
+                    norm=norm,
+                    normalised_scatter=normalised_scatter,
                 )
 
+                if (
+                    projection == Projection.DEFAULT
+                    and image.base_name == config.thumbnail_image
+                ):
+                    save_thumbnail_from_scatter(
+                        config=config,
+                        image=image,
+                        output_path=halo_directory,
+                        normalised_scatter=normalised_scatter,
+                    )
+
+        clear_caches(getattr(data, particle_type, None))
+
+    return
+
+
+def group_haloes(config: ImageConfig, haloes: List[Halo]) -> List[List[Halo]]:
+    """
+    Groups together haloes whose read region lies entirely within the
+    read region of a larger halo, such that the data for each group only
+    needs to be read (and have its smoothing lengths generated) once.
+    This is common for satellites close to a large central.
+
+    Parameters
+    ----------
+
+    config: ImageConfig
+        Opened configuration file.
+
+    haloes: List[Halo]
+        Haloes to visualise.
+
+    Returns
+    -------
+
+    groups: List[List[Halo]]
+        Groups of haloes. The first halo in each group has the largest
+        read region, which contains those of all of the others.
+    """
+
+    if len(haloes) == 0:
+        return []
+
+    units = haloes[0].position.units
+
+    positions = np.array([halo.position.to(units).v for halo in haloes])
+    max_radii = np.array(
+        [
+            max(radius.to(units).v for radius in image_radii(config=config, halo=halo))
+            for halo in haloes
+        ]
+    )
+
+    return [
+        [haloes[index] for index in group]
+        for group in group_nested_regions(positions=positions, radii=max_radii)
+    ]
+
+
+def visualise_halo_group(
+    output_path: Path, snapshot_path: Path, config: ImageConfig, haloes: List[Halo]
+):
+    """
+    Creates all of the visualisations for a group of haloes from
+    ``group_haloes``, reading the data only once.
+
+    Parameters
+    ----------
+
+    output_path: Path, str
+        Output path to save images to.
+
+    snapshot_path: Path,
+        Path to the snapshot.
+
+    config: ImageConfig
+        Opened configuration file.
+
+    haloes: List[Halo]
+        The haloes to visualise. The read region of the first must contain
+        those of all of the others.
+    """
+
+    data = load_halo_data(snapshot_path=snapshot_path, config=config, halo=haloes[0])
+
+    # The data is read for the first halo, so the others must select their
+    # own particles from it.
+    for index, halo in enumerate(haloes):
+        visualise_halo(
+            output_path=output_path,
+            snapshot_path=snapshot_path,
+            config=config,
+            halo=halo,
+            data=data,
+            mask_particles=index > 0,
+        )
+
+    return
+
+
+# Arguments shared by all calls to visualise_halo_group within a process,
+# set by _initialise_worker.
+worker_arguments = {}
+
+
+def _initialise_worker(output_path: Path, snapshot_path: Path, config: ImageConfig):
+    """
+    Stores the arguments shared between all haloes, so that they only need
+    to be sent to each worker process once.
+    """
+
+    worker_arguments.update(
+        output_path=output_path, snapshot_path=snapshot_path, config=config
+    )
+
+    return
+
+
+def _visualise_halo_group_in_worker(haloes: List[Halo]):
+    """
+    Calls ``visualise_halo_group`` for a single group of haloes, using the
+    arguments set by ``_initialise_worker``.
+    """
+
+    visualise_halo_group(haloes=haloes, **worker_arguments)
+
+    return
+
 
 def build_webpage(config: ImageConfig, haloes: List[Halo], output_path: Path):
     """
@@ -671,6 +1142,7 @@ def create_all_images(
     catalogue_path: Path,
     parallel: bool = False,
     debug: bool = False,
+    parallel_mode: str = "process",
 ):
     """
     Create all images, given a config and a set of snapshots
@@ -696,26 +1168,68 @@ def create_all_images(
 
     parallel: bool, optional
         Whether or not to create all images in parallel with each other
-        (uses p_tqdm).
+        (uses a pool of processes, one per core).
 
     debug: bool, optional
         Whether or not to print out the progress of the image creation
-    """
 
-    haloes = haloes_to_visualise(config=config, catalogue_path=catalogue_path)
+    parallel_mode: str, optional
+        When running in parallel, whether to use a pool of processes
+        (``"process"``, the default) or of threads (``"thread"``). Threads
+        share the configuration without copying it, but only run at the
+        same time where the I/O and projection release the GIL.
+    """
 
-    def packed_vis(halo):
-        visualise_halo(
-            output_path=output_path,
-            snapshot_path=snapshot_path,
-            config=config,
-            halo=halo,
+    if parallel_mode not in ["process", "thread"]:
+        raise ValueError(
+            f"Unknown parallel mode {parallel_mode}, expected process or thread."
         )
 
-    if parallel:
-        p_map(packed_vis, haloes, disable=not debug)
+    haloes = haloes_to_visualise(config=config, catalogue_path=catalogue_path)
+    groups = group_haloes(config=config, haloes=haloes)
+
+    if parallel and parallel_mode == "thread":
+        with ThreadPoolExecutor(max_workers=cpu_count() or 1) as executor:
+            list(
+                tqdm(
+                    executor.map(
+                        partial(
+                            visualise_halo_group, output_path, snapshot_path, config
+                        ),
+                        groups,
+                    ),
+                    total=len(groups),
+                    disable=not debug,
+                )
+            )
+    elif parallel and parallel_mode == "process":
+        # Send the configuration to each worker once, and the haloes in
+        # batches, rather than pickling everything for every halo.
+        number_of_workers = cpu_count() or 1
+        chunksize = max(1, len(groups) // (4 * number_of_workers))
+
+        with ProcessPoolExecutor(
+            max_workers=number_of_workers,
+            initializer=_initialise_worker,
+            initargs=(output_path, snapshot_path, config),
+        ) as executor:
+            list(
+                tqdm(
+                    executor.map(
+                        _visualise_halo_group_in_worker, groups, chunksize=chunksize
+                    ),
+                    total=len(groups),
+                    disable=not debug,
+                )
+            )
     else:
-        list(map(packed_vis, tqdm(haloes, disable=not debug)))
+        for group in tqdm(groups, disable=not debug):
+            visualise_halo_group(
+                output_path=output_path,
+                snapshot_path=snapshot_path,
+                config=config,
+                haloes=group,
+            )
 
     build_webpage(config=config, haloes=haloes, output_path=output_path)
 
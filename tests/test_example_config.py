@@ -2,11 +2,31 @@
 Tests that loading the config works and does not crash.
 """
 
-from swiftpipeline.config import Config
+import os
+import json
+import shutil
+import datetime
+
+import pytest
+
+from swiftpipeline.config import Config, load_yaml, _parse_yaml, _sidecar_filename
 from swiftpipeline.imageconfig import ImageConfig
 
 
-def test_config(path="tests/test_config"):
+@pytest.fixture
+def path(tmp_path):
+    """
+    Copy of the example config, as loading it writes the JSON sidecar
+    files next to the yaml files.
+    """
+
+    directory = tmp_path / "test_config"
+    shutil.copytree("tests/test_config", directory)
+
+    return str(directory)
+
+
+def test_config(path):
     """
     Tests loading a config doesn't induce a crash, and
     that we have valid data.
@@ -15,10 +35,84 @@ def test_config(path="tests/test_config"):
     config = Config(config_directory=path)
 
 
-def test_image_config(path="tests/test_config"):
+def test_config_reload(path):
+    """
+    Tests that re-loading a (cached) config gives independent objects
+    with the same contents.
+    """
+
+    config = Config(config_directory=path)
+    config.raw_config["scripts"].append({})
+
+    reloaded_config = Config(config_directory=path)
+
+    assert len(reloaded_config.raw_config["scripts"]) == len(config.scripts)
+    assert len(reloaded_config.scripts) == len(config.scripts)
+
+
+def test_config_load(path):
+    """
+    Tests that loading the same config twice re-uses the first one.
+    """
+
+    config = Config.load(config_directory=path)
+
+    assert Config.load(config_directory=path) is config
+    assert len(config.modification_times) == 1 + len(
+        config.raw_config.get("extra_config", [])
+    )
+
+
+def test_image_config(path):
     """
     Tests loading an image config doesn't induce a crash,
     and that we have valid data.
     """
 
     config = ImageConfig(config_directory=path)
+
+
+def test_yaml_sidecar(tmp_path):
+    """
+    Tests that the JSON sidecar of a yaml file is re-used, ignored once the
+    yaml file has changed, and not written for contents that JSON can not
+    represent.
+    """
+
+    filename = str(tmp_path / "config.yml")
+
+    with open(filename, "w") as handle:
+        handle.write("scripts:\n  - filename: a.py\n")
+
+    contents = load_yaml(filename)
+
+    assert contents == {"scripts": [{"filename": "a.py"}]}
+    assert os.path.exists(_sidecar_filename(filename))
+
+    # The sidecar is used in place of the yaml file (in a new process, i.e.
+    # without the in-memory cache) while the yaml file is unchanged.
+    modification_time = os.stat(filename).st_mtime_ns
+
+    with open(_sidecar_filename(filename), "w") as handle:
+        json.dump(dict(modification_time=modification_time, contents="sidecar"), handle)
+
+    _parse_yaml.cache_clear()
+
+    assert load_yaml(filename) == "sidecar"
+
+    # ...but not once the yaml file has been modified.
+    os.utime(filename, ns=(modification_time, modification_time + 1))
+    _parse_yaml.cache_clear()
+
+    assert load_yaml(filename) == contents
+
+    # Dates are read as date objects, which do not survive JSON.
+    os.remove(_sidecar_filename(filename))
+
+    with open(filename, "w") as handle:
+        handle.write("date: 2020-01-01\n")
+
+    _parse_yaml.cache_clear()
+
+    assert load_yaml(filename) == {"date": datetime.date(2020, 1, 1)}
+    assert not os.path.exists(_sidecar_filename(filename))
@@ -0,0 +1,106 @@
+"""
+Tests the choice of haloes to make images of.
+"""
+
+import numpy as np
+
+from swiftpipeline.haloselection import subsample_bins, group_nested_regions
+
+
+def subsample_bins_loop(digitized, maximum_per_bin, rng):
+    """
+    The original loop over bins that ``subsample_bins`` replaced.
+    """
+
+    chosen = np.zeros(len(digitized), dtype=bool)
+
+    for bin_id in range(1, digitized.max() + 1):
+        matches = digitized == bin_id
+        number_of_matches = matches.sum()
+
+        if number_of_matches > maximum_per_bin:
+            choices = rng.choice(number_of_matches, size=maximum_per_bin, replace=False)
+
+            chosen[np.where(matches)[0][choices]] = True
+        else:
+            chosen[matches] = True
+
+    return chosen
+
+
+def test_subsample_bins(number_of_haloes=1000, maximum_per_bin=20):
+    """
+    Tests that the same number of haloes is chosen from each bin as by
+    the original loop, and that these are a random subset of each bin.
+    """
+
+    rng = np.random.default_rng(seed=1234)
+
+    digitized = np.digitize(
+        rng.normal(12.0, 1.0, number_of_haloes), bins=np.arange(10.0, 15.0, 0.25)
+    )
+
+    chosen = subsample_bins(
+        digitized=digitized, maximum_per_bin=maximum_per_bin, rng=rng
+    )
+    expected = subsample_bins_loop(
+        digitized=digitized, maximum_per_bin=maximum_per_bin, rng=rng
+    )
+
+    chosen_counts = np.bincount(digitized[chosen], minlength=digitized.max() + 1)
+    expected_counts = np.bincount(digitized[expected], minlength=digitized.max() + 1)
+
+    assert (chosen_counts == expected_counts).all()
+    assert chosen_counts[0] == 0
+    assert chosen_counts.max() == maximum_per_bin
+
+    # A different seed must give a different choice.
+    other_chosen = subsample_bins(
+        digitized=digitized,
+        maximum_per_bin=maximum_per_bin,
+        rng=np.random.default_rng(seed=4321),
+    )
+
+    assert (other_chosen != chosen).any()
+
+
+def test_group_nested_regions():
+    """
+    Tests grouping a hand-built set of regions, including ones that only
+    partially overlap a larger region (which must not be grouped with it).
+    """
+
+    positions = np.array(
+        [
+            [0.0, 0.0, 0.0],  # 0: central, containing 1 and 2
+            [0.5, 0.0, 0.0],  # 1: well inside 0
+            [0.0, -0.9, 0.9],  # 2: inside 0, touching its edge
+            [1.5, 0.0, 0.0],  # 3: overlaps 0, but is not inside it
+            [5.0, 5.0, 5.0],  # 4: isolated, containing 5
+            [5.0, 5.0, 5.1],  # 5: inside 4
+            [-5.0, 0.0, 0.0],  # 6: isolated
+        ]
+    )
+    radii = np.array([1.0, 0.2, 0.1, 0.6, 0.5, 0.3, 0.1])
+
+    groups = group_nested_regions(positions=positions, radii=radii)
+
+    # Parents come first, then their children in index order.
+    assert [list(group) for group in groups] == [[0, 1, 2], [3], [4, 5], [6]]
+
+    # Every region is in exactly one group.
+    assert sorted(np.concatenate(groups)) == list(range(len(radii)))
+
+
+def test_group_nested_regions_identical():
+    """
+    Tests that identical regions (e.g. haloes with the same position and
+    size) are read once, rather than both claiming to be a parent.
+    """
+
+    groups = group_nested_regions(
+        positions=np.zeros((3, 3)), radii=np.array([1.0, 1.0, 1.0])
+    )
+
+    assert len(groups) == 1
+    assert sorted(groups[0]) == [0, 1, 2]
@@ -0,0 +1,204 @@
+"""
+Tests the fast logarithmic histogramming against numpy.
+"""
+
+import numpy as np
+import h5py
+import pytest
+
+from unyt import unyt_array
+
+import swiftpipeline.histogram as histogram_module
+
+from swiftpipeline.histogram import (
+    log_histogram_2d,
+    coarsen_histogram,
+    disk_cached_histogram,
+)
+
+
+# Bounds of the histograms made by random_histogram. The particles extend
+# beyond these.
+x_bounds = [1e-3, 1e3]
+y_bounds = [1e0, 1e8]
+
+
+def random_histogram(number_of_particles, bins):
+    """
+    Creates a (reproducible) set of random particles, and their histogram
+    with ``log_histogram_2d``.
+    """
+
+    rng = np.random.default_rng(seed=1234)
+
+    x = 10.0 ** rng.uniform(-4.0, 4.0, number_of_particles)
+    y = 10.0 ** rng.uniform(-1.0, 9.0, number_of_particles)
+
+    histogram = log_histogram_2d(
+        x=x, y=y, x_bounds=x_bounds, y_bounds=y_bounds, bins=bins
+    )
+
+    return x, y, histogram
+
+
+def test_log_histogram_2d(number_of_particles=10000, bins=32):
+    """
+    Tests that the histogram agrees with ``np.histogram2d`` for
+    logarithmically spaced bins, including particles out of range.
+    """
+
+    x, y, histogram = random_histogram(number_of_particles, bins)
+
+    # Invalid values must not end up in any bin
+    invalid_histogram = log_histogram_2d(
+        x=np.concatenate([x, [0.0, np.nan, np.inf, 1.0]]),
+        y=np.concatenate([y, [1e4, 1e4, 1e4, np.nan]]),
+        x_bounds=x_bounds,
+        y_bounds=y_bounds,
+        bins=bins,
+    )
+
+    assert (histogram == invalid_histogram).all()
+
+    expected, _, _ = np.histogram2d(
+        np.log10(x),
+        np.log10(y),
+        bins=[
+            np.linspace(*np.log10(x_bounds), bins + 1),
+            np.linspace(*np.log10(y_bounds), bins + 1),
+        ],
+    )
+
+    assert histogram.shape == (bins, bins)
+    assert histogram.flags.c_contiguous
+    assert (histogram == expected.T).all()
+
+
+def test_log_histogram_2d_lengths():
+    """
+    Tests that particle arrays of different lengths are rejected, rather
+    than the kernel reading past the end of the shorter one.
+    """
+
+    with pytest.raises(ValueError):
+        log_histogram_2d(
+            x=np.full(100000, 1.0),
+            y=np.full(10, 1e4),
+            x_bounds=x_bounds,
+            y_bounds=y_bounds,
+            bins=32,
+        )
+
+
+def test_log_histogram_2d_factors(number_of_particles=10000, bins=32):
+    """
+    Tests that passing conversion factors is equivalent to converting
+    the values before binning.
+    """
+
+    x, y, histogram = random_histogram(number_of_particles, bins)
+
+    factor_histogram = log_histogram_2d(
+        x=x * 1e3,
+        y=y / 2.0,
+        x_bounds=x_bounds,
+        y_bounds=y_bounds,
+        bins=bins,
+        x_factor=1e-3,
+        y_factor=2.0,
+    )
+
+    # Allow for particles sitting right on a bin edge moving between bins
+    assert np.abs(histogram - factor_histogram).sum() <= 2
+
+
+def test_log_histogram_2d_chunked(tmp_path, number_of_particles=10000, bins=32):
+    """
+    Tests that reading (and binning) a HDF5 dataset in chunks gives
+    the same result as binning the whole array at once.
+    """
+
+    x, y, histogram = random_histogram(number_of_particles, bins)
+
+    with h5py.File(tmp_path / "particles.hdf5", "w") as handle:
+        handle.create_dataset("x", data=x)
+        handle.create_dataset("y", data=y)
+
+    with h5py.File(tmp_path / "particles.hdf5", "r") as handle:
+        chunked_histogram = log_histogram_2d(
+            x=handle["x"],
+            y=handle["y"],
+            x_bounds=x_bounds,
+            y_bounds=y_bounds,
+            bins=bins,
+            chunk_size=999,
+        )
+
+    assert (histogram == chunked_histogram).all()
+
+
+def test_coarsen_histogram(number_of_particles=10000, bins=32):
+    """
+    Tests that coarsening a histogram is equivalent to making it with
+    fewer bins in the first place.
+    """
+
+    x, y, histogram = random_histogram(number_of_particles, bins)
+
+    fine_histogram = log_histogram_2d(
+        x=x, y=y, x_bounds=x_bounds, y_bounds=y_bounds, bins=bins * 4
+    )
+
+    # Allow for particles sitting right on a bin edge moving between bins
+    assert np.abs(histogram - coarsen_histogram(fine_histogram, bins)).sum() <= 2
+
+
+def test_disk_cached_histogram(tmp_path, monkeypatch):
+    """
+    Tests that cached histograms are re-used for the same file and
+    arguments, and re-computed when either changes.
+    """
+
+    snapshot = tmp_path / "snapshot.hdf5"
+    snapshot.write_bytes(b"snapshot")
+
+    calls = []
+
+    @disk_cached_histogram(directory=str(tmp_path / "cache"))
+    def make_histogram(filename, edges):
+        calls.append(edges)
+        return np.full((len(edges), len(edges)), len(calls))
+
+    first = make_histogram(str(snapshot), np.arange(4))
+    second = make_histogram(str(snapshot), np.arange(4))
+
+    assert len(calls) == 1
+    assert (first == second).all()
+
+    make_histogram(str(snapshot), np.arange(5))
+
+    assert len(calls) == 2
+
+    # The same values in different units must not share a cache entry.
+    make_histogram(str(snapshot), unyt_array(np.arange(5), "K"))
+    make_histogram(str(snapshot), unyt_array(np.arange(5), "keV"))
+
+    assert len(calls) == 4
+
+    # Nor must histograms cached by an older version.
+    monkeypatch.setattr(
+        histogram_module, "cache_version", histogram_module.cache_version + 1
+    )
+    make_histogram(str(snapshot), np.arange(4))
+
+    assert len(calls) == 5
+
+    # A cached histogram that fails to be written leaves nothing behind.
+    def fail_replace(source, destination):
+        raise OSError("Unable to replace")
+
+    monkeypatch.setattr(histogram_module.os, "replace", fail_replace)
+    make_histogram(str(snapshot), np.arange(6))
+
+    assert len(calls) == 6
+    assert not list((tmp_path / "cache").glob("*.tmp"))
@@ -2,7 +2,7 @@
 Tests the HTML generation code, with mocked up example scripts.
 """
 
-from swiftpipeline.html import WebpageCreator
+from swiftpipeline.html import WebpageCreator, format_number
 
 
 def test_basic():
@@ -20,3 +20,15 @@ def test_basic():
     creator.render_webpage()
 
     return
+
+
+def test_format_number():
+    """
+    Tests that numbers are written as powers of ten when required.
+    """
+
+    assert format_number(0.125) == "\\(0.125\\)"
+    assert format_number(123456.0) == "\\(1.23 \\times 10^{5}\\)"
+    assert format_number(1e-5) == "\\(1 \\times 10^{-5}\\)"
+
+    return